@@ -1,59 +1,278 @@
 #!/usr/bin/env python
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import xml.etree.ElementTree as ET
+from uniprot_client import UniprotClient
 
-def get_entries_from_query(query, verbose=True):
-    entries = []
+client = UniprotClient()
+
+# Cache of the raw Unitprot entries (None: no cache). Replaced by uniprot_cache.open_cache(...) to share the cache of
+# Unitprot-importer.py (same content: the XML document returned for a single ID)
+entry_cache = None
+
+# The entries stored in entry_cache are serialized with the default namespace of Unitprot, like its responses
+ET.register_namespace("", "http://uniprot.org/uniprot")
+
+def iter_entries_from_query(query, verbose=True, page_size=500):
+    """
+    Stream the IDs returned by a query: the result pages (following the 'next' links of the responses) are parsed while
+    they are downloaded.
+
+    :param str query: Unitprot query
+    :param bool verbose: be verbose
+    :param int page_size: number of IDs requested per page
+    :return: generator of Unitprot IDs
+    :raise requests.exceptions.RequestException: if a page could not be retrieved (the IDs already yielded are only
+    part of the result)
+    """
     if verbose:
         print("Interrogating Unitprot with the following query: '{}'".format(query))
-    try:
-        r = requests.get("https://www.uniprot.org/uniprot/?query={}&columns=id&format=tab&limit=10".format(query),
-                         timeout=5)
-    except requests.exceptions.Timeout:
-        print("ERROR! Unitprot does not respond!")
 
-    if r.status_code != requests.codes.ok:
-        if verbose:
-            print("Sorry Unitprot didn't like the query (Status code= {}".format(r.status_code))
-    else:
-        for val in r.text.split('\n'):
-            val = val.strip()
+    count = 0
+    url = "{}/uniprot/?query={}&columns=id&format=tab&size={}".format(client.base_url, query, page_size)
+    while url:
+        r = client.get(url, timeout=5, stream=True)
+        with r:
+            if r.status_code != requests.codes.ok:
+                raise requests.exceptions.HTTPError("Sorry Unitprot didn't like the query (Status code= {})".format(
+                    r.status_code), response=r)
 
-            if len(val) == 0:
-                continue
-            elif val == "Entry":
-                continue
+            url = r.links.get("next", {}).get("url")
+            if r.encoding is None:
+                r.encoding = "utf-8"
+            for val in r.iter_lines(decode_unicode=True):
+                val = val.strip()
 
-            entries.append(val)
+                if len(val) == 0:
+                    continue
+                elif val == "Entry":
+                    continue
 
-        if verbose:
-            print("Unitprot returned {} entries".format(len(entries)))
-    return entries
+                count += 1
+                yield val
+
+    if verbose:
+        print("Unitprot returned {} entries".format(count))
+
+
+def get_entries_from_query(query, verbose=True, limit=None):
+    """
+    :param int limit: maximum number of IDs to retrieve (all of them if None)
+    :return: list of Unitprot IDs
+    :raise requests.exceptions.RequestException: if the result could not be retrieved entirely
+    """
+    return list(itertools.islice(iter_entries_from_query(query, verbose=verbose), limit))
 
 
 def get_entry_from_id(entry_id, verbose=True):
     content = None
     if verbose:
         print("Retrieving ID={} from Unitprot... ".format(entry_id), end="")
+
+    text = entry_cache.get(entry_id) if entry_cache is not None else None
+    if text is not None:
+        if verbose:
+            print("No need: loading data from cache")
+        return ET.fromstring(text)
+
     try:
-        r = requests.get("https://www.uniprot.org/uniprot/{}.xml".format(entry_id),
-                         timeout=5)
-    except requests.exceptions.Timeout:
+        r = client.get("{}/uniprot/{}.xml".format(client.base_url, entry_id),
+                       timeout=5)
+    except requests.exceptions.RequestException:
         print("ERROR! Unitprot does not respond!")
+        return content
 
     if r.status_code != requests.codes.ok:
         if verbose:
             print("Sorry Unitprot didn't like the query (Status code= {}".format(r.status_code))
     else:
         content = ET.fromstring(r.text)
+        if entry_cache is not None:
+            entry_cache.put(entry_id, r.text)
 
         if verbose:
             print("OK")
     return content
 
 
+def get_entries_from_ids(entry_ids, chunk_size=100, verbose=True):
+    """
+    Retrieve several Unitprot entries using one request per chunk of `chunk_size` IDs.
+
+    The entries found in entry_cache are not requested, and the retrieved ones are added to it.
+
+    :param list entry_ids: Unitprot IDs
+    :param int chunk_size: maximum number of IDs requested at once
+    :param bool verbose: be verbose
+    :return: dict mapping the retrieved IDs to their <entry> element
+    """
+    contents = {}
+    if entry_cache is not None:
+        for entry_id, text in entry_cache.get_many(entry_ids).items():
+            contents[entry_id] = ET.fromstring(text).find("{*}entry")
+
+    missing_ids = [entry_id for entry_id in entry_ids if entry_id not in contents]
+    for start in range(0, len(missing_ids), chunk_size):
+        chunk = missing_ids[start:start + chunk_size]
+
+        if verbose:
+            print("Retrieving {} IDs from Unitprot... ".format(len(chunk)), end="")
+        try:
+            r = client.get("{}/uniprot/?query={}&format=xml".format(client.base_url,
+                "+OR+".join("accession:{}".format(entry_id) for entry_id in chunk)),
+                timeout=30)
+        except requests.exceptions.RequestException:
+            print("ERROR! Unitprot does not respond!")
+            continue
+
+        if r.status_code != requests.codes.ok:
+            if verbose:
+                print("Sorry Unitprot didn't like the query (Status code= {}".format(r.status_code))
+            continue
+
+        root = ET.fromstring(r.text)
+        requested_ids = set(chunk)
+        retrieved_texts = {}
+        for elem in root.iterfind("{*}entry"):
+            # The requested ID may be a secondary accession of the entry
+            for accession in elem.iterfind("{*}accession"):
+                if accession.text in requested_ids:
+                    contents[accession.text] = elem
+                    retrieved_texts[accession.text] = _get_entry_document(root, elem)
+                    break
+        if entry_cache is not None:
+            entry_cache.put_many(retrieved_texts)
+
+        if verbose:
+            print("OK")
+    return contents
+
+
+def _get_entry_document(root, elem):
+    """
+    Serialize an entry of a response as a single-entry document, just like the response to a single ID request.
+
+    :param root: root element of the response
+    :param elem: <entry> element of the response
+    :return: string
+    """
+    document = ET.Element(root.tag)
+    document.append(elem)
+    return ET.tostring(document, encoding="unicode")
+
+
+async def _run_in_thread(func, *args, semaphore=None, timeout=None, executor=None):
+    """
+    Run a blocking function in a thread without blocking the event loop.
+
+    The slot of the semaphore is held until the thread is done: on timeout or cancellation, the caller returns at once
+    but the request (which cannot be interrupted) still counts against the concurrency limit until it completes.
+
+    :param concurrent.futures.ThreadPoolExecutor executor: threads running the function (default executor of the loop,
+    limited to min(32, CPUs + 4) threads, if None)
+    :raise asyncio.TimeoutError: if the function does not return within `timeout` seconds
+    """
+    if semaphore is not None:
+        await semaphore.acquire()
+    future = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def done(future):
+        if semaphore is not None:
+            semaphore.release()
+        # The result of an abandoned call is not reported
+        if not future.cancelled():
+            future.exception()
+
+    future.add_done_callback(done)
+    return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+
+async def get_entries_from_query_async(query, verbose=True, limit=None, timeout=None):
+    """
+    Async counterpart of get_entries_from_query.
+
+    :param float timeout: maximum time (in seconds) to retrieve all the IDs (no limit if None)
+    :return: list of Unitprot IDs (empty if the query times out)
+    """
+    try:
+        return await _run_in_thread(get_entries_from_query, query, verbose, limit, timeout=timeout)
+    except asyncio.TimeoutError:
+        print("ERROR! Unitprot did not return the result of the query '{}' in time".format(query))
+        return []
+
+
+async def get_entry_from_id_async(entry_id, verbose=False, timeout=30, semaphore=None, executor=None):
+    """
+    Async counterpart of get_entry_from_id (which uses entry_cache too).
+
+    :param float timeout: maximum time (in seconds) to retrieve the entry, including the retries (no limit if None)
+    :param asyncio.Semaphore semaphore: limit of the concurrent requests shared with other calls (no limit if None)
+    :param concurrent.futures.ThreadPoolExecutor executor: threads sending the requests (see _run_in_thread)
+    :return: the <entry> element (None if the entry could not be retrieved in time)
+    """
+    try:
+        return await _run_in_thread(get_entry_from_id, entry_id, verbose, semaphore=semaphore, timeout=timeout,
+                                    executor=executor)
+    except asyncio.TimeoutError:
+        print("ERROR! Unitprot did not return ID={} in time".format(entry_id))
+        return None
+
+
+async def _get_entry_item(entry_id, verbose, timeout, semaphore, executor):
+    return entry_id, await get_entry_from_id_async(entry_id, verbose=verbose, timeout=timeout, semaphore=semaphore,
+                                                   executor=executor)
+
+
+async def iter_entries_from_ids_async(entry_ids, concurrency=10, timeout=30, verbose=False):
+    """
+    Retrieve Unitprot entries with up to `concurrency` concurrent requests, yielding them as they complete.
+
+    Only `concurrency` requests are scheduled at a time, so that entry_ids may be a long (or lazy) iterable. They are
+    sent from `concurrency` threads of their own, whatever the number of CPUs. Closing the generator cancels the
+    pending requests.
+
+    :param entry_ids: iterable of Unitprot IDs
+    :param int concurrency: maximum number of concurrent requests (the pool of the client keeps 10 connections)
+    :param float timeout: maximum time (in seconds) to retrieve each entry (no limit if None)
+    :param bool verbose: be verbose
+    :return: async generator of (ID, <entry> element or None), in completion order
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # The semaphore is only released once the thread is done: a request which timed out still holds its thread
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    entry_ids = iter(entry_ids)
+    pending = set()
+    try:
+        while True:
+            for entry_id in itertools.islice(entry_ids, concurrency - len(pending)):
+                pending.add(asyncio.ensure_future(_get_entry_item(entry_id, verbose, timeout, semaphore, executor)))
+            if len(pending) == 0:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        # The requests already sent complete in the background
+        executor.shutdown(wait=False)
+
+
+async def get_entries_from_ids_async(entry_ids, concurrency=10, timeout=30, verbose=False):
+    """
+    Same as iter_entries_from_ids_async but wait for all the entries.
+
+    :return: dict mapping the IDs to their <entry> element (None if the entry could not be retrieved)
+    """
+    return dict([item async for item in iter_entries_from_ids_async(entry_ids, concurrency=concurrency,
+                                                                     timeout=timeout, verbose=verbose)])
+
+
 if __name__ == "__main__":
-    entries = get_entries_from_query("antimicrobial")
+    entries = get_entries_from_query("antimicrobial", limit=10)
 
     print(entries)
 
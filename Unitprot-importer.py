@@ -3,10 +3,24 @@ import requests
 from lxml import etree as ET
 from lxml import objectify
 from adaptable import Entry, Library
+from uniprot_cache import DirectoryCache, MemoryCache, QueryCache, SQLiteCache, get_tmp_fname, migrate_cache, \
+    open_cache, write_json
+from uniprot_client import UniprotClient
+from uniprot_metrics import Metrics, NullMetrics, ProgressReporter
+from uniprot_warnings import WarningCollector
 import sys
 import os
 import logging
-from collections import defaultdict
+import itertools
+import gzip
+import json
+import pickle
+import re
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import signal
 
 # See https://www.uniprot.org/docs/keywlist for the complete list
 BIOPROPERTIES_UNIPROT_KEYWORDS = {
@@ -29,9 +43,203 @@ BIOPROPERTIES_UNIPROT_KEYWORDS = {
     ],
 }
 
+# Keywords looked for in the (lowercased) content of the elements that are not processed
+TEXT_KEYWORDS = {
+    "antimicrobial":
+        [
+            "microbial",
+        ],
+    "antigram_pos":
+        [
+            "gram-positive",
+        ],
+    "antigram_neg":
+        [
+            "gram-negative",
+        ],
+    "antibacterial":
+        [
+            "bacterial",
+        ],
+    "antiviral":
+        [
+            "viral",
+        ],
+    "anticancer":
+        [
+            "cancer", "tumor", "anticancer", "antitumor",
+        ],
+    "antiprotozoal":
+        [
+            "protozoa",
+        ],
+    "antiplasmodial":
+        [
+            "plasmodi",
+        ],
+    "antiparasitic":
+        [
+            "parasit",
+        ],
+    "antitrypanosomic":
+        [
+            "trypanosom",
+        ],
+    "antileishmania":
+        [
+            "leishman",
+        ],
+    "insecticidal":
+        [
+            "insecticid",
+        ],
+    "toxic": [
+        "toxic",
+    ],
+    "cytotoxic":
+        [
+            "cytotoxic",
+        ],
+    "antiangiogenic":
+        [
+            "antiangiogen",
+        ],
+    "hemolytic":
+        [
+            "hemolytic",
+        ],
+    "pdb":
+        [
+            "pdb",
+        ],
+    "PMID":
+        [
+            "PMID"
+        ],
+    "DSSP":
+        [
+            "DSSP"
+        ]
+}
+
+# Databases whose references are not stored in ADAPTABLE
+IGNORED_DATABASES = frozenset([
+    "GO",  # Gene Ontology
+    "InterPro",
+    "EC",  # ExPASy/Brenda
+    "EMBL",  # European Nucleotide Archive
+    "EnsemblBacteria",
+    "OrthoDB",
+    "Proteomes",
+    "RefSeq",  # Reference genome sequences
+    "PRINTS",  # Protein Motif fingerprint database
+    "PATRIC",  # Pathosystems database
+    "BioCyc",  # Pathway/Genome database
+    "GeneID",
+    "Gene3D",
+    "PANTHER",  # Genome DB
+    "SMART",
+    "UniPathway",
+    "KEGG",  # Genomic DB
+    "HOGENOM",  # Genomic DB
+    "OMA",  # Genome DB
+    "UniGene",
+    "MGI",  # Mouse Genome DB
+    "UCSC",  # Genome Browser
+    "Bgee",  # Gene expression DB
+    "IntAct",  # Prot-Prot interaction DB
+    "PeptideAtlas",  # Proteomic DB
+    "PRIDE",  # Proteomic DB
+    "FlyBase",  # Drosophila Genome DB
+    "eggNOG",  # Genome DB
+    "PDBsum",  # Ignored as redondant with PDB
+    "PIR",  # Non structural Protein DB
+    "STRING",  # Prot-Prot interaction
+    "PaxDb",  # Protein Abundance Database
+    "HOVERGEN",
+    "TCDB",  # Transport Protein DB
+    "MINT",  # Prot-Prot interaction
+    "EvolutionaryTrace",  # Evolutionary DB
+    "ArachnoServer",  # Prot DB dedicated to spider toxins
+    "CAZy",  # Carbohydrate-active enzymes DB
+    "Ensembl",  # Genome DB
+    "PMAP-CutDB",  # Proteolytic DB
+    "MaizeGDB",  # Maize Genome DB
+    "iPTMnet",  # System biology DB
+    "KO",  # Ortholog DB
+    "Genevisible",
+    "ExpressionAtlas",
+    "SABIO-RK",  # Biochme kinetic DB
+    "Allergome",  # Allergen DB
+    "PRO",  # Protein ontology DB
+    "DisProt",
+    "InParanoid",  # Phylogenic DB
+    "Araport",  # Arabido DB
+    "ConoServer",  # Cone sanil toxin DB
+])
+
+# Databases whose references are stored as IDs, with the prefix used in ADAPTABLE
+DATABASE_ID_PREFIXES = {
+    "SUPFAM": "supfam",  # Super Family of protein
+    "Pfam": "pfam",  # Family of protein
+    "ProteinModelPortal": "pmp",
+    "TIGRFAMs": "tigrfams",
+    "HAMAP": "hamap",
+    "PROSITE": "prosite",
+    "PIRSF": "pirsf",
+    "CDD": "cdd",
+    "ProDom": "prodom",
+    "SMR": "smr",
+}
+
+# Lookup tables compiled once from the dicts above: Unitprot keyword ID -> bioproperties and flat (keyword, bioproperty)
+# rules, in the order of TEXT_KEYWORDS
+BIOPROPERTIES_BY_UNIPROT_KEYWORD = {
+    kwid: tuple(name for name, kwids in BIOPROPERTIES_UNIPROT_KEYWORDS.items() if kwid in kwids)
+    for kwids in BIOPROPERTIES_UNIPROT_KEYWORDS.values() for kwid in kwids
+}
+TEXT_KEYWORD_RULES = tuple((keyword, bioproperty)
+                           for bioproperty, keywords in TEXT_KEYWORDS.items() for keyword in keywords)
+
+# Cache used to store the raw Unitprot entries (replaced according to the command line options)
+entry_cache = DirectoryCache(".cache")
 
-def get_uniprot_entries_from_query(query, verbose=True, max_length=50, reviewed=True):
-    entries = []
+# In-memory LRU cache of the parsed entries, in front of entry_cache (None to disable it). The sizes are the lengths
+# of the XML documents
+parsed_entry_cache = MemoryCache(max_entries=1000, max_size=64 * 1024 * 1024)
+
+# Cache used to store the results of the queries (replaced according to the command line options)
+query_cache = QueryCache(".cache_queries")
+
+# HTTP client used for all the requests sent to Unitprot (replaced according to the command line options)
+http_client = UniprotClient()
+
+# Warnings of the import: all of them are logged, unless a summary is preferred (see the command line options)
+warning_collector = WarningCollector(verbose=True)
+
+# Instrumentation of the import stages (replaced by a Metrics if the metrics are exported)
+metrics = NullMetrics()
+
+
+def iter_uniprot_entries_from_query(query, verbose=True, max_length=50, reviewed=True, with_versions=False,
+                                    use_cache=True, page_size=500, offline=False):
+    """
+    Stream the result of a Unitprot query: the entries of each result page (following the 'next' links of the
+    responses) are yielded once it is downloaded, so that the entries can be retrieved before the whole list is known.
+
+    The result is stored in the query cache (see uniprot_cache.QueryCache): each completed page is appended to the
+    partial result (an interrupted listing continues after the last completed page) which becomes the cached result
+    once the last page is received. Concurrent importers of the same query share the listing: each page is downloaded
+    by a single process, under the lock of the result, and read from the partial result by the others.
+
+    :param bool with_versions: also retrieve the version of the entries
+    :param bool use_cache: use the cached result of the query, if it did not expire (the result is cached anyway)
+    :param int page_size: number of entries requested per page
+    :param bool offline: only use the cached result (even if it expired), nothing is downloaded
+    :return: generator of Unitprot IDs, or of (ID, version) tuples if with_versions is True
+    :raise requests.exceptions.RequestException: if a page of the result could not be retrieved (after the retries of
+    http_client) or if the result is not cached in offline mode: the IDs already yielded are only part of the result
+    """
     if verbose:
         print("Interrogating Unitprot with the following query: '{}' "
               "and a max sequence length of {} (reviewed={})... ".format(query,
@@ -40,73 +248,187 @@ def get_uniprot_entries_from_query(query, verbose=True, max_length=50, reviewed=
               )
         sys.stdout.flush()
 
-    response = ""
-    cache_file = ".cache_uniprot_{}_{}_{}".format(query, max_length, reviewed)
-
-    if os.path.isfile(cache_file):
-        print("No need: cache file found and used!")
-        with open(cache_file, "r") as fp:
-            response = fp.read()
-    else:
-        try:
-            if reviewed:
-                reviewed = "yes"
-            else:
-                reviewed = "no"
-
-            timeout = 60
-            r = requests.get("https://www.uniprot.org/uniprot/?query={}+length:[1+TO+{}]+AND+reviewed:{}&columns=id&format=tab".format(query, max_length, reviewed),
-                             timeout=timeout)
-        except requests.exceptions.Timeout:
-            print("ERROR! Unitprot did not respond within {} seconds!".format(timeout))
-        else:
-            if r.status_code != requests.codes.ok:
-                if verbose:
-                    print("Sorry Unitprot didn't like the query (Status code= {})".format(r.status_code))
+    columns = "id,version(entry)" if with_versions else "id"
+    params = {"query": query, "max_length": max_length, "reviewed": reviewed, "columns": columns}
+    key = query_cache.get_key(params)
+
+    count = 0
+    if use_cache or offline:
+        manifest = query_cache.get_manifest(key)
+        if manifest is None:
+            manifest = _import_legacy_query_cache(key, params, with_versions)
+        if manifest is not None and (offline or query_cache.is_fresh(manifest)):
+            metrics.inc("query_cache_total", result="hit")
+            print("No need: cache file found and used!")
+            for entry in _iter_query_entries(query_cache.iter_lines(key), with_versions):
+                count += 1
+                yield entry
+            if verbose:
+                print("Unitprot returned {} entries".format(count))
+                sys.stdout.flush()
+            return
+    if offline:
+        raise requests.exceptions.ConnectionError("The result of the query is not cached (offline mode)")
+
+    first_url = "{}/uniprot/?query={}+length:[1+TO+{}]+AND+reviewed:{}&columns={}&format=tab&size={}".format(
+        http_client.base_url, query, max_length, "yes" if reviewed else "no", columns, page_size)
+
+    # The lock is only held while a page is downloaded and appended to the partial result (or while the pages appended
+    # by another importer are read), not while the entries are yielded: concurrent importers of the same query share
+    # the listing page by page
+    start_time = time.time()
+    # Number of lines of the result already yielded
+    consumed = 0
+    first = True
+    complete = False
+    while not complete:
+        with query_cache.lock(key):
+            manifest = query_cache.get_manifest(key)
+            if manifest is not None and query_cache.is_fresh(manifest) and \
+                    (use_cache or manifest["created"] >= start_time):
+                # Another importer listed the query meanwhile
+                if first:
+                    metrics.inc("query_cache_total", result="hit")
+                    print("No need: cache file found and used!")
+                lines = list(itertools.islice(query_cache.iter_lines(key), consumed, None))
+                complete = True
             else:
-                print("OK")
-                response = r.text
-                with open(cache_file, "w") as fp:
-                    fp.write(response)
+                if first:
+                    metrics.inc("query_cache_total", result="miss")
 
-    for val in response.split('\n'):
-        val = val.strip()
+                partial = query_cache.get_partial(key)
+                if partial is not None and not use_cache and partial["started"] < start_time:
+                    partial = None
 
-        if len(val) == 0:
-            continue
-        elif val == "Entry":
-            continue
-
-        entries.append(val)
+                if partial is not None and partial["lines"] > consumed:
+                    # Pages appended by another importer, or by an interrupted listing which is continued
+                    lines = list(itertools.islice(query_cache.iter_partial_lines(key), consumed, None))
+                else:
+                    if partial is None or not partial["next_url"]:
+                        query_cache.start_partial(key, params)
+                        url, nlines = first_url, 0
+                    else:
+                        url, nlines = partial["next_url"], partial["lines"]
+
+                    page_lines, next_url = _download_query_page(url)
+                    metrics.inc("query_pages_total")
+                    query_cache.append_page(key, page_lines, next_url)
+
+                    # The partial result may have been started again by another importer
+                    lines = page_lines[max(0, consumed - nlines):]
+                    complete = not next_url
+                    if complete and verbose:
+                        print("OK")
+        first = False
+
+        consumed += len(lines)
+        for entry in _iter_query_entries(lines, with_versions):
+            count += 1
+            yield entry
 
     if verbose:
-        print("Unitprot returned {} entries".format(len(entries)))
+        print("Unitprot returned {} entries".format(count))
         sys.stdout.flush()
-    return entries
 
 
-def get_uniprot_entry_from_id(entry_id, verbose=False):
-    content = None
+def _download_query_page(url):
+    """
+    Download a page of the result of a query (the transient failures are retried by http_client).
+
+    :return: (lines, URL of the next page or None)
+    :raise requests.exceptions.RequestException: if the page could not be retrieved
+    """
+    with metrics.time("query"):
+        r = http_client.get(url, timeout=60, stream=True)
+    with r:
+        if r.status_code != requests.codes.ok:
+            raise requests.exceptions.HTTPError("Sorry Unitprot didn't like the query (Status code= {})".format(
+                r.status_code), response=r)
+        if r.encoding is None:
+            r.encoding = "utf-8"
+        return list(r.iter_lines(decode_unicode=True)), r.links.get("next", {}).get("url")
+
+
+def _import_legacy_query_cache(key, params, with_versions):
+    """
+    Import the result cached by the previous versions (.cache_uniprot_<query>_<max length>_<reviewed>[_versions] file)
+    into the query cache.
+
+    :return: the manifest of the imported result or None if there is no such file
+    """
+    legacy_file = ".cache_uniprot_{}_{}_{}".format(params["query"], params["max_length"], params["reviewed"])
+    if with_versions:
+        legacy_file += "_versions"
+    try:
+        if not os.path.isfile(legacy_file):
+            return None
+    except ValueError:
+        return None
+
+    with open(legacy_file, "r") as fp:
+        query_cache.put(key, params, (val.rstrip("\n") for val in fp), created=os.path.getmtime(legacy_file))
+    return query_cache.get_manifest(key)
+
+
+def _iter_query_entries(lines, with_versions):
+    for val in lines:
+        entry = _parse_query_line(val, with_versions)
+        if entry is not None:
+            yield entry
+
+
+def _parse_query_line(val, with_versions):
+    val = val.strip()
+
+    if len(val) == 0:
+        return None
+    elif val.split("\t")[0] == "Entry":
+        return None
+
+    if with_versions:
+        entry_id, version = val.split("\t")[:2]
+        return entry_id, version.strip()
+    return val
 
-    cache_dir = ".cache"
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
 
-    cache_file = os.path.join(cache_dir, "uniprot-{}".format(entry_id))
+def get_uniprot_entries_from_query(query, verbose=True, max_length=50, reviewed=True, with_versions=False,
+                                   use_cache=True, offline=False):
+    """
+    Same as iter_uniprot_entries_from_query but return the whole list.
+    """
+    return list(iter_uniprot_entries_from_query(query, verbose=verbose, max_length=max_length, reviewed=reviewed,
+                                                with_versions=with_versions, use_cache=use_cache, offline=offline))
+
+
+def parse_uniprot_xml(text):
+    """
+    :param str text: a Unitprot XML document (as returned for a single ID) or a single <entry> element
+    :return: the <entry> element
+    """
+    with metrics.time("parse"):
+        root = ET.fromstring(text.encode('utf-8'))
+    if get_tag(root) == "entry":
+        return root
+    return root[0]
+
+
+def get_uniprot_xml_from_id(entry_id, verbose=False):
+    content = None
 
     if verbose:
         print("  Retrieving ID={} from Unitprot... ".format(entry_id), end="")
 
-    if os.path.isfile(cache_file):
-        with open(cache_file, 'r') as fp:
-            content = ET.fromstring(fp.read().encode('utf-8'))[0]
+    with metrics.time("cache"):
+        content = entry_cache.get(entry_id)
+    metrics.inc("cache_lookups_total", result="miss" if content is None else "hit")
+    if content is not None:
         if verbose:
             print("No need: loading data from cache file")
     else:
         try:
-            r = requests.get("https://www.uniprot.org/uniprot/{}.xml".format(entry_id),
-                             timeout=5)
-        except requests.exceptions.Timeout:
+            r = http_client.get("{}/uniprot/{}.xml".format(http_client.base_url, entry_id),
+                                timeout=5)
+        except requests.exceptions.RequestException:
             print("ERROR! Unitprot does not respond!")
             return content
 
@@ -114,11 +436,9 @@ def get_uniprot_entry_from_id(entry_id, verbose=False):
             if verbose:
                 print("Sorry Unitprot didn't like the query (Status code= {}".format(r.status_code))
         else:
-            response_text = r.text
-            content = ET.fromstring(response_text.encode('utf-8'))[0]
+            content = r.text
 
-            with open(cache_file, "w") as fp:
-                fp.write(response_text)
+            entry_cache.put(entry_id, content)
 
             if verbose:
                 print("OK")
@@ -126,6 +446,187 @@ def get_uniprot_entry_from_id(entry_id, verbose=False):
     return content
 
 
+def get_uniprot_entry_from_id(entry_id, verbose=False):
+    """
+    :return: the parsed <entry> element (None if the entry could not be retrieved), shared with the other callers
+    through parsed_entry_cache: it must not be modified
+    """
+    def load():
+        content = get_uniprot_xml_from_id(entry_id, verbose=verbose)
+        if content is None:
+            return None, 0
+        return parse_uniprot_xml(content), len(content)
+
+    if parsed_entry_cache is None:
+        return load()[0]
+    return parsed_entry_cache.get_or_load(entry_id, load)
+
+
+def get_uniprot_xmls_from_ids(entry_ids, chunk_size=100, verbose=False):
+    """
+    Retrieve several Unitprot entries using one request per chunk of `chunk_size` IDs.
+
+    Each <entry> of the multi-entry responses is stored in the per-ID cache so the entries can later be retrieved using
+    get_uniprot_entry_from_id. IDs that are missing from a response are retrieved one by one.
+
+    :param list entry_ids: Unitprot IDs
+    :param int chunk_size: maximum number of IDs requested at once
+    :param bool verbose: be verbose
+    :return: list of XML documents (None if the entry could not be retrieved), in the same order as entry_ids
+    """
+    with metrics.time("cache"):
+        contents = entry_cache.get_many(entry_ids)
+    metrics.inc("cache_lookups_total", len(contents), result="hit")
+    metrics.inc("cache_lookups_total", len(entry_ids) - len(contents), result="miss")
+
+    missing_ids = [entry_id for entry_id in entry_ids if entry_id not in contents]
+    for start in range(0, len(missing_ids), chunk_size):
+        chunk = missing_ids[start:start + chunk_size]
+
+        if verbose:
+            print("  Retrieving {} IDs from Unitprot... ".format(len(chunk)), end="")
+
+        try:
+            r = http_client.get("{}/uniprot/?query={}&format=xml".format(http_client.base_url,
+                "+OR+".join("accession:{}".format(entry_id) for entry_id in chunk)),
+                timeout=30)
+        except requests.exceptions.RequestException:
+            print("ERROR! Unitprot does not respond!")
+            continue
+
+        if r.status_code != requests.codes.ok:
+            if verbose:
+                print("Sorry Unitprot didn't like the query (Status code= {}".format(r.status_code))
+            continue
+
+        root = ET.fromstring(r.text.encode('utf-8'))
+        requested_ids = set(chunk)
+        retrieved_texts = {}
+        for elem in list(root.iterchildren("{*}entry")):
+            # The requested ID may be a secondary accession of the entry
+            for accession in elem.iterchildren("{*}accession"):
+                if accession.text in requested_ids:
+                    entry_id = accession.text
+                    break
+            else:
+                continue
+
+            # Store the entry as a single-entry document, just like the response to a single ID request
+            document = ET.Element(root.tag, nsmap=root.nsmap)
+            document.append(elem)
+            retrieved_texts[entry_id] = ET.tounicode(document)
+        entry_cache.put_many(retrieved_texts)
+        contents.update(retrieved_texts)
+
+        if verbose:
+            print("OK")
+
+    return [contents[entry_id] if entry_id in contents else get_uniprot_xml_from_id(entry_id, verbose=verbose)
+            for entry_id in entry_ids]
+
+
+def get_uniprot_entries_from_ids(entry_ids, chunk_size=100, verbose=False):
+    """
+    Same as get_uniprot_xmls_from_ids but return the parsed entries (None if the entry could not be retrieved). The
+    entries already in parsed_entry_cache are neither read from entry_cache nor parsed again, and the entries being
+    retrieved by other threads are waited for instead of being retrieved again.
+    """
+    def load_many(missing_ids):
+        return [(None, 0) if content is None else (parse_uniprot_xml(content), len(content))
+                for content in get_uniprot_xmls_from_ids(missing_ids, chunk_size=chunk_size, verbose=verbose)]
+
+    if parsed_entry_cache is None:
+        return [tree for tree, _ in load_many(entry_ids)]
+    return parsed_entry_cache.get_or_load_many(entry_ids, load_many)
+
+
+def iter_uniprot_entries_from_ids(entry_ids, jobs=1, verbose=False, batch_size=0, raw=False):
+    """
+    Retrieve Unitprot entries using up to `jobs` concurrent downloads.
+
+    The entries are yielded in the same order as `entry_ids` and at most 2*`jobs` downloads are pending at any time.
+
+    :param entry_ids: iterable of Unitprot IDs
+    :param int jobs: number of concurrent downloads (1 means sequential retrieval)
+    :param bool verbose: be verbose
+    :param int batch_size: number of IDs retrieved per request (0 means one request per ID)
+    :param bool raw: yield the XML documents instead of the parsed entries
+    :return: generator of (entry_id, tree) tuples, tree being None if the entry could not be retrieved
+    """
+    if batch_size > 0:
+        fetch_chunk = get_uniprot_xmls_from_ids if raw else get_uniprot_entries_from_ids
+
+        def fetch(chunk):
+            with metrics.time("fetch"):
+                return fetch_chunk(chunk, chunk_size=batch_size, verbose=verbose)
+    else:
+        batch_size = 1
+        fetch_one = get_uniprot_xml_from_id if raw else get_uniprot_entry_from_id
+
+        def fetch(chunk):
+            with metrics.time("fetch"):
+                return [fetch_one(chunk[0], verbose=verbose)]
+
+    entry_ids = iter(entry_ids)
+    chunks = iter(lambda: list(itertools.islice(entry_ids, batch_size)), [])
+
+    if jobs <= 1:
+        for chunk in chunks:
+            yield from zip(chunk, fetch(chunk))
+        return
+
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def submit(n):
+        for chunk in itertools.islice(chunks, n):
+            pending.append((chunk, executor.submit(fetch, chunk)))
+
+    try:
+        submit(2 * jobs)
+        while pending:
+            chunk, future = pending.popleft()
+            trees = future.result()
+            submit(1)
+            yield from zip(chunk, trees)
+    finally:
+        # Called on exhaustion but also on abort (max errors, KeyboardInterrupt): drop what is not started yet
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_uniprot_entries_from_file(fname, max_length=50, reviewed=True, keywords=None):
+    """
+    Stream the entries from a local Unitprot XML file (e.g. uniprot_sprot.xml.gz).
+
+    The file is parsed incrementally and every <entry> element is cleared once consumed so the memory usage does not
+    depend on the size of the file.
+
+    :param str fname: path to the XML file (gzip-compressed if the name ends with .gz)
+    :param int max_length: maximum length (number of AA) of the sequence
+    :param bool reviewed: keep only reviewed (Swiss-Prot) entries if True, only non-reviewed (TrEMBL) ones otherwise
+    :param keywords: Unitprot keyword IDs (e.g. KW-0929). If not None, keep only entries with at least one of them
+    :return: generator of (entry_id, tree) tuples
+    """
+    if keywords is not None:
+        keywords = set(keywords)
+    dataset = "Swiss-Prot" if reviewed else "TrEMBL"
+
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "rb") as fp:
+        for _, elem in ET.iterparse(fp, events=("end",), tag="{*}entry", huge_tree=True):
+            sequence = elem.find("{*}sequence")
+            if elem.get("dataset") == dataset and \
+                    sequence is not None and 1 <= int(sequence.get("length")) <= max_length and \
+                    (keywords is None or
+                     any(kwelem.get("id") in keywords for kwelem in elem.iterchildren("{*}keyword"))):
+                yield elem.findtext("{*}accession"), elem
+
+            # Free the entry and the (already cleared) previous ones still referenced by the root element
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
 def get_sequence_from_uniprot_xml(tree):
     """
 
@@ -136,98 +637,49 @@ def get_sequence_from_uniprot_xml(tree):
     return tree.find("{*}sequence").text.replace("\n", "")
 
 
+def get_version_from_uniprot_xml(tree):
+    return {"version": tree.get("version"), "modified": tree.get("modified")}
+
+
+def get_version_from_uniprot_document(content):
+    """
+    Get the version of an entry from its XML document without parsing it.
+    """
+    match = _entry_version_pattern.search(content)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+_entry_version_pattern = re.compile(r"<entry\b[^>]*\sversion=\"([^\"]*)\"")
+
+
 def get_tag(elem):
     return ET.QName(elem.tag).localname
 
 
+def get_searchable_text(elem):
+    """
+    Get the lowercased text and attribute values of an element and of its descendants.
+
+    This is what the keywords are looked for in, without serializing the element: the markup itself (tags, attribute
+    names, namespaces) never contains any of the keywords.
+    """
+    pieces = []
+    for node in elem.iter():
+        pieces.extend(node.attrib.values())
+        if node.text:
+            pieces.append(node.text)
+        if node is not elem and node.tail:
+            pieces.append(node.tail)
+    return "\0".join(pieces).lower()
+
+
 def populate_entry_using_uniprot_xml(entry, tree, debug=False):
-    KEYWORDS = {
-        "antimicrobial":
-            [
-                "microbial",
-            ],
-        "antigram_pos":
-            [
-                "gram-positive",
-            ],
-        "antigram_neg":
-            [
-                "gram-negative",
-            ],
-        "antibacterial":
-            [
-                "bacterial",
-            ],
-        "antiviral":
-            [
-                "viral",
-            ],
-        "anticancer":
-            [
-                "cancer", "tumor", "anticancer", "antitumor",
-            ],
-        "antiprotozoal":
-            [
-                "protozoa",
-            ],
-        "antiplasmodial":
-            [
-                "plasmodi",
-            ],
-        "antiparasitic":
-            [
-                "parasit",
-            ],
-        "antitrypanosomic":
-            [
-                "trypanosom",
-            ],
-        "antileishmania":
-            [
-                "leishman",
-            ],
-        "insecticidal":
-            [
-                "insecticid",
-            ],
-        "toxic": [
-            "toxic",
-        ],
-        "cytotoxic":
-            [
-                "cytotoxic",
-            ],
-        "antiangiogenic":
-            [
-                "antiangiogen",
-            ],
-        "hemolytic":
-            [
-                "hemolytic",
-            ],
-        "pdb":
-            [
-                "pdb",
-            ],
-        "PMID":
-            [
-                "PMID"
-            ],
-        "DSSP":
-            [
-                "DSSP"
-            ]
-    }
-
-    potential_properties = defaultdict(list)
+    matched_elements = []
 
     entry_id = "UNKNOWN"
 
-    def warning_cry(elem, element_type="element"):
-        logger.warning("Uniprot Entry '{}' -> the following {} is ignored but could be interesting: {}".format(
-            entry_id,
-            element_type,
-            ET.tounicode(elem)))
     # TODO: check space in text
     for elem in tree:
         tag = get_tag(elem)
@@ -251,106 +703,87 @@ def populate_entry_using_uniprot_xml(entry, tree, debug=False):
             dbtype = elem.get("type")
 
             # Ignored databases
-            if dbtype in [
-                "GO",  # Gene Ontology
-                "InterPro",
-                "EC",  # ExPASy/Brenda
-                "EMBL",  # European Nucleotide Archive
-                "EnsemblBacteria",
-                "OrthoDB",
-                "Proteomes",
-                "RefSeq",  # Reference genome sequences
-                "PRINTS",  # Protein Motif fingerprint database
-                "PATRIC",  # Pathosystems database
-                "BioCyc",  # Pathway/Genome database
-                "GeneID",
-                "Gene3D",
-                "PANTHER",  # Genome DB
-                "SMART",
-                "UniPathway",
-                "KEGG",  # Genomic DB
-                "HOGENOM",  # Genomic DB
-                "OMA",  # Genome DB
-                "UniGene",
-                "MGI",  # Mouse Genome DB
-                "UCSC",  # Genome Browser
-                "Bgee",  # Gene expression DB
-                "IntAct",  # Prot-Prot interaction DB
-                "PeptideAtlas",  # Proteomic DB
-                "PRIDE",  # Proteomic DB
-                "FlyBase",  # Drosophila Genome DB
-                "eggNOG",  # Genome DB
-                "PDBsum",  # Ignored as redondant with PDB
-                "PIR",  # Non structural Protein DB
-                "STRING",  # Prot-Prot interaction
-                "PaxDb",  # Protein Abundance Database
-                "HOVERGEN",
-                "TCDB",  # Transport Protein DB
-                "MINT",  # Prot-Prot interaction
-                "EvolutionaryTrace",  # Evolutionary DB
-                "ArachnoServer",  # Prot DB dedicated to spider toxins
-                "CAZy",  # Carbohydrate-active enzymes DB
-                "Ensembl",  # Genome DB
-                "PMAP-CutDB",  # Proteolytic DB
-                "MaizeGDB",  # Maize Genome DB
-                "iPTMnet",  # System biology DB
-                "KO",  # Ortholog DB
-                "Genevisible",
-                "ExpressionAtlas",
-                "SABIO-RK",  # Biochme kinetic DB
-                "Allergome",  # Allergen DB
-                "PRO",  # Protein ontology DB
-                "DisProt",
-                "InParanoid",  # Phylogenic DB
-                "Araport",  # Arabido DB
-                "ConoServer",  # Cone sanil toxin DB
-                          ]:
+            if dbtype in IGNORED_DATABASES:
                 continue
-            elif dbtype == "SUPFAM":  # Super Family of protein
-                entry["ID"].append("supfam{}".format(elem.get("id")))
-            elif dbtype == "Pfam":  # Family of protein
-                entry["ID"].append("pfam{}".format(elem.get("id")))
-            elif dbtype == "ProteinModelPortal":
-                entry["ID"].append("pmp{}".format(elem.get("id")))
-            elif dbtype == "TIGRFAMs":
-                entry["ID"].append("tigrfams{}".format(elem.get("id")))
-            elif dbtype == "HAMAP":
-                entry["ID"].append("hamap{}".format(elem.get("id")))
-            elif dbtype == "PROSITE":
-                entry["ID"].append("prosite{}".format(elem.get("id")))
-            elif dbtype == "PIRSF":
-                entry["ID"].append("pirsf{}".format(elem.get("id")))
-            elif dbtype == "CDD":
-                entry["ID"].append("cdd{}".format(elem.get("id")))
-            elif dbtype == "ProDom":
-                entry["ID"].append("prodom{}".format(elem.get("id")))
-            elif dbtype == "SMR":
-                entry["ID"].append("smr{}".format(elem.get("id")))
+            elif dbtype in DATABASE_ID_PREFIXES:
+                entry["ID"].append("{}{}".format(DATABASE_ID_PREFIXES[dbtype], elem.get("id")))
             elif dbtype == "PDB":
                 entry["pdb"].append(elem.get("id")) # TODO: also add it experment_structre
             else:
-                warning_cry(elem, "Database ({})".format(dbtype))
+                _warn_ignored_database(entry_id, dbtype, lambda: ET.tounicode(elem))
         elif tag == "keyword":
-            kwid = elem.get("id")
-
-            for name, keywords in BIOPROPERTIES_UNIPROT_KEYWORDS.items():
-                if kwid in keywords:
-                    if len(entry[name]) == 0:
-                        entry[name].append(name)
+            for name in BIOPROPERTIES_BY_UNIPROT_KEYWORD.get(elem.get("id"), ()):
+                if len(entry[name]) == 0:
+                    entry[name].append(name)
         else:
             if debug:
                 print("DEBUG: Tag '{}' will be ignored".format(tag))
+            _warn_ignored_tag(entry_id, tag)
+
+            bioproperties = _get_text_bioproperties(get_searchable_text(elem))
+            if len(bioproperties) > 0:
+                matched_elements.append((elem, bioproperties))
+
+    _log_potential_properties(entry, entry_id, matched_elements)
+
+
+def _report_warning(category, key, get_message=None, logged=True):
+    """
+    Count a warning (see WarningCollector.add) and log it if all the warnings are logged.
+    """
+    message = warning_collector.add(category, key, get_message, logged)
+    if message is not None:
+        logger.warning(message)
 
-            flat_elem = ET.tounicode(elem).lower()
-            for bioproperty, keywords in KEYWORDS.items():
-                for keyword in keywords:
-                    if keyword in flat_elem:
-                        potential_properties[flat_elem].append(bioproperty)
-                        break
+
+def _warn_ignored_database(entry_id, dbtype, serialize):
+    """
+    :param serialize: function returning the XML of the database reference (only called if it is needed)
+    """
+    _report_warning("unknown_database", dbtype,
+                    lambda: "Uniprot Entry '{}' -> the following {} is ignored but could be interesting: {}".format(
+                        entry_id,
+                        "Database ({})".format(dbtype),
+                        serialize()))
+
+
+def _warn_ignored_tag(entry_id, tag):
+    # Only counted: these elements were never logged
+    _report_warning("ignored_tag", tag, lambda: "Entry {} -> <{}> element ignored".format(entry_id, tag),
+                    logged=False)
+
+
+def _get_text_bioproperties(text):
+    """
+    :param str text: searchable text of an element (see get_searchable_text)
+    :return: the bioproperties whose keywords are found in the text
+    """
+    # dict.fromkeys: a bioproperty is reported once even if several of its keywords are found
+    return list(dict.fromkeys(bioproperty for keyword, bioproperty in TEXT_KEYWORD_RULES if keyword in text))
+
+
+def _log_potential_properties(entry, entry_id, matched_elements):
+    """
+    Log the elements containing keywords of bioproperties that the entry does not have.
+
+    :param list matched_elements: (element, bioproperties) tuples
+    """
+    if warning_collector.verbose:
+        # Identical elements are logged together
+        potential_properties = defaultdict(list)
+        for elem, bioproperties in matched_elements:
+            if any(len(entry[bioproperty]) == 0 for bioproperty in bioproperties):
+                potential_properties[ET.tounicode(elem).lower()].extend(bioproperties)
+        flat_elems = [(lambda flat_elem=flat_elem: flat_elem, bioproperties)
+                      for flat_elem, bioproperties in potential_properties.items()]
+    else:
+        # Elements are only serialized if they are kept as examples
+        flat_elems = [(lambda elem=elem: ET.tounicode(elem).lower(), bioproperties)
+                      for elem, bioproperties in matched_elements]
 
     # Check potential properties
     log_entry = False
-    for flat_elem, potential_properties in potential_properties.items():
+    for get_flat_elem, potential_properties in flat_elems:
         for bioproperty in potential_properties:
             if len(entry[bioproperty]) == 0:
                 if bioproperty in ["DSSP", "pdb"]:
@@ -360,34 +793,342 @@ def populate_entry_using_uniprot_xml(entry, tree, debug=False):
                 else:
                     message = "information about {} properties".format(bioproperty)
 
-                logger.warning("Entry {} -> "
-                               "Potential {} ignored but contained in the following element: {}".format(
-                    entry_id,
-                    message,
-                    flat_elem
-                ))
+                _report_warning("potential_property", bioproperty,
+                                lambda: "Entry {} -> "
+                                        "Potential {} ignored but contained in the following element: {}".format(
+                                    entry_id,
+                                    message,
+                                    get_flat_elem()
+                                ))
                 log_entry = True
 
-    if log_entry:
+    # The whole entry is only logged along with all the warnings
+    if log_entry and warning_collector.verbose:
         logger.warning("Entry {} content:\n{}".format(
             entry_id,
             entry.as_human_readable()
         ))
 
 
+def build_entry_from_uniprot_xml(tree):
+    with metrics.time("populate"):
+        entry = Entry(get_sequence_from_uniprot_xml(tree))
+        populate_entry_using_uniprot_xml(entry, tree)
+    return entry
+
+
+class _RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+_worker_log_collector = None
+
+
+def _init_worker(metrics_enabled=False, warnings_verbose=True, max_warning_examples=3):
+    global logger, metrics, warning_collector, _worker_log_collector
+
+    # Interruptions are handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Warnings are collected and sent back to the parent process which logs them in order
+    _worker_log_collector = _RecordCollector()
+    logger = logging.getLogger('Uniport-importer.worker')
+    logger.propagate = False
+    logger.addHandler(_worker_log_collector)
+    logger.setLevel(logging.WARNING)
+    # ... as well as their summary
+    warning_collector = WarningCollector(verbose=warnings_verbose, max_examples=max_warning_examples)
+
+    # The metrics are sent back to the parent process along with the entries
+    if metrics_enabled:
+        metrics = Metrics()
+
+
+def _build_entries_from_xmls(contents):
+    results = []
+    for content in contents:
+        _worker_log_collector.records = []
+        entry = None
+        version = None
+        if content is not None:
+            tree = parse_uniprot_xml(content)
+            entry = build_entry_from_uniprot_xml(tree)
+            version = get_version_from_uniprot_xml(tree)
+        results.append((entry, version, _worker_log_collector.records))
+    return results, metrics.pop_state(), warning_collector.pop_state()
+
+
+def iter_entries_using_processes(contents, processes, chunk_size=50):
+    """
+    Parse the Unitprot XML documents and populate the corresponding ADAPTABLE entries in worker processes.
+
+    The warnings logged by the workers are passed to the logger of this process, in the order of the entries.
+
+    :param contents: iterable of (entry_id, XML document) tuples, the document being None if it could not be retrieved
+    :param int processes: number of worker processes
+    :param int chunk_size: number of documents sent at once to a worker
+    :return: generator of (entry_id, entry, version) tuples in the same order as contents, entry and version being None
+    if the document is missing
+    """
+    contents = iter(contents)
+    pending = deque()
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(metrics.enabled, warning_collector.verbose,
+                                             warning_collector.max_examples))
+
+    def submit(n):
+        for _ in range(n):
+            chunk = list(itertools.islice(contents, chunk_size))
+            if len(chunk) == 0:
+                return
+            entry_ids, chunk_contents = zip(*chunk)
+            pending.append((entry_ids, executor.submit(_build_entries_from_xmls, chunk_contents)))
+
+    try:
+        submit(2 * processes)
+        while pending:
+            entry_ids, future = pending.popleft()
+            results, worker_metrics, worker_warnings = future.result()
+            metrics.merge(worker_metrics)
+            warning_collector.merge(worker_warnings)
+            submit(1)
+            for entry_id, (entry, version, records) in zip(entry_ids, results):
+                for record in records:
+                    logger.handle(record)
+                yield entry_id, entry, version
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_checkpoint_fnames(library):
+    return "{}.checkpoint".format(library.fname), "{}.checkpoint.entries".format(library.fname)
+
+
+def save_checkpoint(library, state, records):
+    """
+    Save the import state (position in the list of IDs...) so the import can be resumed.
+
+    The entries imported since the previous checkpoint are appended to the checkpoint entries file (pickled, as the
+    FASTA format does not preserve property values containing spaces).
+
+    :param dict state: import state
+    :param list records: (entry_id, version, entry) tuples imported since the previous checkpoint
+    """
+    state_fname, entries_fname = _get_checkpoint_fnames(library)
+    with open(entries_fname, "ab") as fp:
+        pickle.dump(records, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        fp.flush()
+        os.fsync(fp.fileno())
+        state = dict(state, entries_size=fp.tell())
+    write_json(state_fname, state)
+
+
+def load_checkpoint(library):
+    """
+    Load the checkpoint of an interrupted import.
+
+    :return: (state, records) or None if there is no checkpoint, records being the imported (entry_id, version, entry)
+    """
+    state_fname, entries_fname = _get_checkpoint_fnames(library)
+    try:
+        with open(state_fname, "r") as fp:
+            state = json.load(fp)
+    except FileNotFoundError:
+        return None
+
+    records = []
+    with open(entries_fname, "r+b") as fp:
+        while fp.tell() < state["entries_size"]:
+            records.extend(pickle.load(fp))
+        # Drop what may have been written after the checkpoint state
+        fp.truncate(state["entries_size"])
+    return state, records
+
+
+def remove_checkpoint(library):
+    for fname in _get_checkpoint_fnames(library):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def load_import_state(library):
+    """
+    :return: the entries imported by the previous import (ID -> (version, entry))
+    """
+    try:
+        with open("{}.import-state".format(library.fname), "rb") as fp:
+            return pickle.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_import_state(library, imported):
+    """
+    Save the imported entries for the next incremental import (see load_import_state).
+    """
+    fname = "{}.import-state".format(library.fname)
+    tmp_fname = get_tmp_fname(fname)
+    with open(tmp_fname, "wb") as fp:
+        pickle.dump(imported, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, fname)
+
+
+def discard_outdated_cache_entries(versions, chunk_size=1000):
+    """
+    Remove the cached entries whose version differs from the expected one so they are downloaded again.
+
+    :param dict versions: Unitprot ID -> current version
+    """
+    entry_ids = list(versions)
+    for start in range(0, len(entry_ids), chunk_size):
+        contents = entry_cache.get_many(entry_ids[start:start + chunk_size])
+        outdated_ids = [entry_id for entry_id, content in contents.items()
+                        if get_version_from_uniprot_document(content) != versions[entry_id]]
+        entry_cache.delete_many(outdated_ids)
+        if parsed_entry_cache is not None:
+            parsed_entry_cache.invalidate(outdated_ids)
+
+
+def read_queries_file(fname):
+    """
+    :return: the queries listed in a file, one per line (blank lines, lines starting with '#' and duplicates are
+    ignored)
+    """
+    queries = []
+    with open(fname, "r") as fp:
+        for line in fp:
+            query = line.strip()
+            if len(query) > 0 and not query.startswith("#") and query not in queries:
+                queries.append(query)
+    return queries
+
+
+def resolve_queries(queries, jobs=1, **kwargs):
+    """
+    List the IDs returned by several queries (up to `jobs` queries at a time) and take their union, so that an ID
+    returned by several queries is only retrieved and populated once.
+
+    :param kwargs: options of get_uniprot_entries_from_query
+    :return: dict mapping the queries to their IDs and the union of the IDs (in the order of the queries)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(lambda query: get_uniprot_entries_from_query(query, **kwargs), queries))
+
+    query_ids = dict(zip(queries, results))
+    entry_ids = list(dict.fromkeys(entry_id for ids in results for entry_id in ids))
+    return query_ids, entry_ids
+
+
+def get_query_libraries(basename, query_ids, imported):
+    """
+    Split the entries of a batch import into one library per query (the same library as an import of the query alone).
+
+    :param dict query_ids: query -> IDs returned by the query
+    :param dict imported: imported entries (ID -> (version, entry)), shared by all the queries
+    :return: list of (query, library)
+    """
+    libraries = []
+    for query, entry_ids in query_ids.items():
+        library = Library("{}_{}".format(basename, query))
+        for entry_id in entry_ids:
+            if entry_id in imported:
+                library.add(imported[entry_id][1])
+        libraries.append((query, library))
+    return libraries
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Process a Unitprot query and create a database accordingly.')
-    parser.add_argument("query", help="Query to send to Unitprot server")
+    parser.add_argument("query", nargs="?", help="Query to send to Unitprot server")
+    parser.add_argument("--queries-file",
+                        help="Batch mode: file listing several queries (one per line). Each entry is retrieved and "
+                             "populated once, even if several queries return it, and one database is saved per query")
     parser.add_argument("--max-length", type=int, default=50,
                         help="Specify the maximum length (number of AA) for the Unitprot query")
     parser.add_argument("--verbose", action="store_true", help="Be verbose")
     parser.add_argument("--nonreviewed", action="store_false", help="Search for non-reviewed entries", dest="reviewed")
     parser.add_argument("--basename", help="Base name for the file where the database will be saved to", default="DATABASE")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Number of entries downloaded concurrently from Unitprot")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of entries retrieved per Unitprot request (0 to use one request per entry)")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Number of worker processes used to parse and populate the entries "
+                             "(0 to do it in the main process)")
+    parser.add_argument("--checkpoint-every", type=int, default=1000,
+                        help="Save the partially imported library every N entries (0 to disable)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted import from its last checkpoint")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only download and process the entries whose version changed since the previous "
+                             "incremental import (the first one imports everything)")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="Number of times a failed request to Unitprot is retried")
+    parser.add_argument("--rate-limit", type=float,
+                        help="Maximum number of requests sent to Unitprot per second")
+    parser.add_argument("--uniprot-url", default="https://www.uniprot.org",
+                        help="Base URL of the Unitprot server (e.g. a local stand-in server for benchmarks)")
+    parser.add_argument("--cache-backend", choices=["sqlite", "directory"], default="sqlite",
+                        help="Storage used to cache the Unitprot entries: a single sqlite file or "
+                             "the legacy directory with one file per entry")
+    parser.add_argument("--cache-path",
+                        help="Location of the cache (default: '.cache.sqlite' or '.cache' depending on the backend)")
+    parser.add_argument("--cache-max-size", type=int,
+                        help="Maximum size (in MB) of the sqlite cache. Least recently used entries are evicted")
+    parser.add_argument("--memory-cache-entries", type=int, default=0,
+                        help="Number of parsed entries kept in memory, for the IDs requested several times "
+                             "(default: 0, disabled)")
+    parser.add_argument("--memory-cache-size", type=int, default=64,
+                        help="Maximum size (in MB of XML) of the parsed entries kept in memory")
+    parser.add_argument("--migrate-cache", action="store_true",
+                        help="Import the entries from the legacy '.cache' directory into the sqlite cache first")
+    parser.add_argument("--verbose-warnings", action="store_true",
+                        help="Log every warning in full, with the content of the entries concerned, instead of a "
+                             "summary of the warnings (counts and examples)")
+    parser.add_argument("--warning-examples", type=int, default=3,
+                        help="Number of examples of each kind of warning given in the summary")
+    parser.add_argument("--query-cache-dir", default=".cache_queries",
+                        help="Directory where the results of the queries are cached")
+    parser.add_argument("--query-cache-ttl", type=float,
+                        help="Time (in hours) after which a cached query result expires (default: never)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--refresh", action="store_true",
+                       help="List the result of the query again even if it is cached")
+    group.add_argument("--offline", action="store_true",
+                       help="Only use the cached query result and entries (even if expired): nothing is downloaded")
+    parser.add_argument("--xml-dump",
+                        help="Read the entries from a local Unitprot XML file (optionally gzipped) "
+                             "instead of querying the Unitprot server")
+    parser.add_argument("--keywords",
+                        help="Comma-separated list of Unitprot keyword IDs used to select the entries from the XML "
+                             "file (default: the keywords associated to the query, required if there are none)")
+    parser.add_argument("--metrics-file",
+                        help="File where the metrics of the import (stage durations, cache, HTTP...) are saved to")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json",
+                        help="Format of the metrics file: JSON or Prometheus text format")
+    parser.add_argument("--progress-every", type=float, default=0,
+                        help="Print a progress line with the throughput and ETA every N seconds (0 to disable)")
+    parser.add_argument("--merge-into",
+                        help="Existing ADAPTABLE database into which the imported entries are merged")
+    parser.add_argument("--merged-output",
+                        help="File where the merged database is saved to (default: <basename>_<query>_merged)")
 
     args = parser.parse_args()
 
+    if (args.query is None) == (args.queries_file is None):
+        parser.error("either a query or --queries-file is required")
+    if args.queries_file is not None:
+        for option, value in (("--xml-dump", args.xml_dump), ("--incremental", args.incremental),
+                              ("--merge-into", args.merge_into)):
+            if value:
+                parser.error("{} is not available in batch mode (--queries-file)".format(option))
 
     SILENT = not args.verbose
 
@@ -401,29 +1142,220 @@ if __name__ == "__main__":
     logger.setLevel(logging.WARNING)
 
 
-    #print("Loading ADAPTABLE database:")
-
-    #current_library = Library("../DATABASE")
-    #current_library.read()
-
-    unitprot_library = Library("{}_{}".format(args.basename, args.query))
+    warning_collector = WarningCollector(verbose=args.verbose_warnings, max_examples=args.warning_examples)
+    http_client = UniprotClient(max_retries=args.max_retries, rate_limit=args.rate_limit, pool_size=max(10, args.jobs),
+                                base_url=args.uniprot_url, offline=args.offline)
+    query_cache = QueryCache(args.query_cache_dir,
+                             ttl=args.query_cache_ttl * 3600 if args.query_cache_ttl is not None else None)
+
+    if args.metrics_file is not None:
+        metrics = Metrics()
+        http_client.metrics = metrics
+    import_start = time.perf_counter()
+
+    max_size = args.cache_max_size * 1024 * 1024 if args.cache_max_size is not None else None
+    entry_cache = open_cache(args.cache_backend, args.cache_path, max_size=max_size)
+    parsed_entry_cache = None
+    if args.memory_cache_entries > 0:
+        parsed_entry_cache = MemoryCache(max_entries=args.memory_cache_entries,
+                                         max_size=args.memory_cache_size * 1024 * 1024)
+    if args.migrate_cache:
+        if not isinstance(entry_cache, SQLiteCache):
+            print("ERROR: --migrate-cache requires the sqlite cache backend")
+            sys.exit(1)
+        migrate_cache(DirectoryCache(".cache"), entry_cache)
+    elif isinstance(entry_cache, SQLiteCache) and len(entry_cache) == 0 and os.path.isdir(".cache"):
+        print("Note: the legacy '.cache' directory is not used by the sqlite cache (see --migrate-cache)")
+
+    # The reference database is only indexed: its entries are read from the file when needed
+    current_library = None
+    if args.merge_into is not None:
+        print("Loading ADAPTABLE database:")
+        current_library = Library(args.merge_into, lazy=True)
+        current_library.read()
+
+    # Batch mode: the entries of all the queries are imported in a single library, split by query when saved
+    queries = None
+    if args.queries_file is not None:
+        queries = read_queries_file(args.queries_file)
+        unitprot_library = Library("{}_batch".format(args.basename))
+    else:
+        unitprot_library = Library("{}_{}".format(args.basename, args.query))
+
+    # Import state: position in the list of entries to import and imported entries (ID -> (version, entry))
+    start = 0
+    imported = {}
+    run_parameters = {"query": args.query, "max_length": args.max_length, "reviewed": args.reviewed,
+                      "xml_dump": args.xml_dump}
+    if queries is not None:
+        run_parameters["queries"] = queries
+    if args.resume:
+        checkpoint = load_checkpoint(unitprot_library)
+        if checkpoint is None:
+            print("ERROR: No checkpoint found for '{}'".format(unitprot_library.fname))
+            sys.exit(1)
+        state, records = checkpoint
+        if state["parameters"] != run_parameters:
+            print("ERROR: The checkpoint was created with different parameters: {}".format(state["parameters"]))
+            sys.exit(1)
+        start = state["position"]
+        for entry_id, version, entry in records:
+            unitprot_library.add(entry)
+            imported[entry_id] = (version, entry)
+        print("Resuming import after entry {} ({} entries already imported)".format(start, len(unitprot_library)))
+    else:
+        remove_checkpoint(unitprot_library)
+
+    # Incremental mode: entries whose version did not change are taken from the previous library
+    reusable_entries = {}
+
+    # Number of retrieved entries to skip when resuming the import of a local XML file
+    skip = 0
+    # Whole list of the IDs to import (only known beforehand in incremental mode)
+    entries = None
+    progress_format = "\rProcessing entry {:5d}... "
+
+    # IDs returned by each query of a batch
+    query_ids = None
+    # Number of entries to process when it is known beforehand, but not the whole list of IDs
+    progress_total = None
+
+    if args.xml_dump is None:
+        if queries is not None:
+            try:
+                query_ids, entry_ids = resolve_queries(queries, jobs=args.jobs, verbose=args.verbose,
+                                                       max_length=args.max_length, reviewed=args.reviewed,
+                                                       use_cache=not args.refresh, offline=args.offline)
+            except requests.exceptions.RequestException as e:
+                print("ERROR! The result of the queries could not be retrieved from Unitprot: {}".format(e))
+                sys.exit(1)
+            print("Batch import: {} queries returned {} IDs, {} distinct entries to import".format(
+                len(queries), sum(len(ids) for ids in query_ids.values()), len(entry_ids)))
+            metrics.set("batch_queries", len(queries))
+            metrics.set("batch_entries", len(entry_ids))
+
+            if start > 0 and (start > len(entry_ids) or entry_ids[start - 1] != state["last_id"]):
+                print("ERROR: The result of the queries changed since the checkpoint was created")
+                sys.exit(1)
+            progress_format = "\rProcessing entry {{:5d}}/{:5d}... ".format(len(entry_ids))
+            entry_ids = entry_ids[start:]
+            progress_total = len(entry_ids)
+        elif args.incremental:
+            try:
+                entries = get_uniprot_entries_from_query(args.query, verbose=args.verbose, max_length=args.max_length,
+                                                         reviewed=args.reviewed, with_versions=True, use_cache=False,
+                                                         offline=args.offline)
+            except requests.exceptions.RequestException as e:
+                print("ERROR! The result of the query could not be retrieved from Unitprot: {}".format(e))
+                sys.exit(1)
+            current_versions = dict(entries)
+            entries = [entry_id for entry_id, _ in entries]
+
+            if start > 0 and (start > len(entries) or entries[start - 1] != state["last_id"]):
+                print("ERROR: The result of the query changed since the checkpoint was created")
+                sys.exit(1)
+            progress_format = "\rProcessing entry {{:5d}}/{:5d}... ".format(len(entries))
+            entries = entries[start:]
+
+            previous_import = load_import_state(unitprot_library)
+            for entry_id in entries:
+                if entry_id in previous_import and previous_import[entry_id][0]["version"] == current_versions[entry_id]:
+                    version, entry = previous_import[entry_id]
+                    reusable_entries[entry_id] = (entry, version)
+            del previous_import
+            discard_outdated_cache_entries({entry_id: current_versions[entry_id] for entry_id in entries
+                                            if entry_id not in reusable_entries})
+            print("Incremental import: {} entries did not change".format(len(reusable_entries)))
+
+            entry_ids = [entry_id for entry_id in entries if entry_id not in reusable_entries]
+        else:
+            # The entries are retrieved while the result of the query is still being listed
+            entry_ids = iter_uniprot_entries_from_query(args.query, verbose=args.verbose, max_length=args.max_length,
+                                                        reviewed=args.reviewed, use_cache=not args.refresh,
+                                                        offline=args.offline)
+            if start > 0:
+                try:
+                    skipped_ids = list(itertools.islice(entry_ids, start))
+                except requests.exceptions.RequestException as e:
+                    print("ERROR! The result of the query could not be retrieved from Unitprot: {}".format(e))
+                    sys.exit(1)
+                if len(skipped_ids) < start or skipped_ids[-1] != state["last_id"]:
+                    print("ERROR: The result of the query changed since the checkpoint was created")
+                    sys.exit(1)
+
+        fetcher = iter_uniprot_entries_from_ids(entry_ids, jobs=args.jobs, batch_size=args.batch_size,
+                                                raw=args.processes > 0)
+    else:
+        if args.incremental:
+            print("ERROR: The incremental mode is not available when reading a local XML file")
+            sys.exit(1)
+
+        if args.keywords is not None:
+            keywords = args.keywords.split(",")
+        elif args.query in BIOPROPERTIES_UNIPROT_KEYWORDS:
+            keywords = BIOPROPERTIES_UNIPROT_KEYWORDS[args.query]
+        else:
+            # Without keywords, every entry of the dump (within the length limit) would be imported
+            print("ERROR: No Unitprot keywords are associated to the query '{}': use --keywords to select the "
+                  "entries of the XML file (known queries: {})".format(args.query,
+                                                                      ", ".join(sorted(BIOPROPERTIES_UNIPROT_KEYWORDS))))
+            sys.exit(1)
+        fetcher = iter_uniprot_entries_from_file(args.xml_dump, max_length=args.max_length, reviewed=args.reviewed,
+                                                 keywords=keywords)
+        skip = start
+
+    if args.processes > 0:
+        contents = fetcher
+        if args.xml_dump is not None:
+            # Entries have to be serialized to be sent to the worker processes
+            contents = ((entry_id, ET.tounicode(tree)) for entry_id, tree in fetcher)
+        builder = iter_entries_using_processes(itertools.islice(contents, skip, None),
+                                               args.processes)
+    else:
+        builder = ((entry_id, None, None) if tree is None else
+                   (entry_id, build_entry_from_uniprot_xml(tree), get_version_from_uniprot_xml(tree))
+                   for entry_id, tree in itertools.islice(fetcher, skip, None))
+
+    if entries is not None:
+        def merge_reusable_entries(entry_ids, builder):
+            for entry_id in entry_ids:
+                if entry_id in reusable_entries:
+                    yield (entry_id,) + reusable_entries[entry_id]
+                else:
+                    yield next(builder)
 
-    entries = get_uniprot_entries_from_query(args.query, verbose=args.verbose, max_length=args.max_length, reviewed=args.reviewed)
+        stream = merge_reusable_entries(entries, builder)
+    else:
+        stream = builder
 
     counter_all = 0
     counter_new = 0
+    counter_update = 0
+    counter_unchanged = 0
+    merge_counts = None
     errors = 0
     max_errors = 10
+    position = start
+    last_id = None
+    checkpoint_records = []
+    listing_failed = False
+    progress = None
+    if args.progress_every > 0:
+        progress = ProgressReporter(len(entries) if entries is not None else progress_total,
+                                    args.progress_every)
     try:
-        for num, entry in enumerate(entries):
-            print("\rProcessing entry {:5d}/{:5d}... ".format(num+1, len(entries)), end="")
-
-            tree = get_uniprot_entry_from_id(entry)
+        for num, (entry_id, entry, version) in enumerate(stream):
+            print(progress_format.format(start+num+1), end="")
+            if progress is not None:
+                progress.update(num + 1)
 
-            if tree is None:
+            if entry is None:
+                metrics.inc("entries_total", status="failed")
                 print("WARNING: Could not retrieve ID:{} from Uniprot"
-                      ". It will be ignored".format(entry))
+                      ". It will be ignored".format(entry_id))
                 errors += 1
+                position += 1
+                last_id = entry_id
 
                 if errors > max_errors:
                     print("ERROR: Max errors ({}) reached... Aborting" .format(max_errors))
@@ -432,54 +1364,118 @@ if __name__ == "__main__":
 
             counter_all += 1
 
-            sequence = get_sequence_from_uniprot_xml(tree)
+            sequence = entry.sequence
             ellipsed_sequence = sequence
             if len(ellipsed_sequence) > 50:
                 ellipsed_sequence = ellipsed_sequence[:50] + "..."
 
-            # try:
-            #     raise KeyError
-            #     entry = current_library.entries[sequence]
-            #     if SILENT:
-            #         print("UPDATE", end="")
-            #     else:
-            #         print("UPDATE entry:", end="")
-            # except KeyError:
-            #     entry = Entry(sequence)
-            #
-            #     if SILENT:
-            #         print("NEW   ", end="")
-            #     else:
-            #         print("NEW entry:", end="")
-            #     counter_new += 1
-
-            entry = Entry(sequence)
-
-            if SILENT:
-                print("NEW   ", end="")
+            if current_library is not None and sequence in current_library.entries:
+                if SILENT:
+                    print("UPDATE", end="")
+                else:
+                    print("UPDATE entry:", end="")
+                counter_update += 1
+                metrics.inc("entries_total", status="update")
+            elif entry_id in reusable_entries:
+                if SILENT:
+                    print("SAME  ", end="")
+                else:
+                    print("UNCHANGED entry:", end="")
+                counter_unchanged += 1
+                metrics.inc("entries_total", status="same")
             else:
-                print("NEW entry:", end="")
-            counter_new += 1
+                if SILENT:
+                    print("NEW   ", end="")
+                else:
+                    print("NEW entry:", end="")
+                counter_new += 1
+                metrics.inc("entries_total", status="new")
 
             if not SILENT:
                 print(" '{}'".format(ellipsed_sequence))
 
-            populate_entry_using_uniprot_xml(entry, tree)
-
-            unitprot_library.entries[sequence] = entry
+            unitprot_library.add(entry)
+            imported[entry_id] = (version, entry)
+            checkpoint_records.append((entry_id, version, entry))
+            position += 1
+            last_id = entry_id
+
+            if args.checkpoint_every > 0 and position % args.checkpoint_every == 0:
+                with metrics.time("checkpoint"):
+                    save_checkpoint(unitprot_library, {"parameters": run_parameters, "position": position,
+                                                       "last_id": last_id}, checkpoint_records)
+                checkpoint_records = []
     except KeyboardInterrupt:
         print("Keyboard interrupt triggered! Exiting")
+        if position > start:
+            save_checkpoint(unitprot_library, {"parameters": run_parameters, "position": position,
+                                               "last_id": last_id}, checkpoint_records)
+            print("Progress saved: use --resume to continue the import")
+    except requests.exceptions.RequestException as e:
+        # Only the listing of the query raises: the entries which could not be retrieved are counted as errors
+        print("ERROR! The result of the query could not be retrieved from Unitprot: {}".format(e))
+        listing_failed = True
+        if position > start:
+            save_checkpoint(unitprot_library, {"parameters": run_parameters, "position": position,
+                                               "last_id": last_id}, checkpoint_records)
+            print("Progress saved: use --resume to continue the import")
     else:
         if SILENT:
             print("")
-        unitprot_library.save()
+        with metrics.time("save"):
+            if query_ids is None:
+                unitprot_library.save()
+                # Only read by the next incremental import
+                if args.incremental:
+                    save_import_state(unitprot_library, imported)
+            else:
+                for query, library in get_query_libraries(args.basename, query_ids, imported):
+                    print("Query '{}': {} entries".format(query, len(library)))
+                    library.save()
+        remove_checkpoint(unitprot_library)
+
+        if current_library is not None:
+            print("Merging into ADAPTABLE database '{}':".format(current_library.fname))
+            with metrics.time("merge"):
+                # The reference library is read from FASTA: the entries are compared as they would be saved
+                merge_counts = current_library.merge(unitprot_library, as_stored=True)
+                merged_fname = args.merged_output
+                if merged_fname is None:
+                    merged_fname = "{}_{}_merged".format(args.basename, args.query)
+                current_library.save(merged_fname)
+    finally:
+        stream.close()
+        builder.close()
+        fetcher.close()
+        entry_cache.close()
+        http_client.close()
+        if current_library is not None:
+            current_library.close()
+
+        if len(warning_collector) > 0:
+            logger.warning(warning_collector.format_summary())
+
+        if args.metrics_file is not None:
+            for category, count in warning_collector.get_counts_by_category().items():
+                metrics.set("warnings", count, category=category)
+            if parsed_entry_cache is not None:
+                for name, value in parsed_entry_cache.get_stats().items():
+                    metrics.set("memory_cache", value, stat=name)
+            elapsed = time.perf_counter() - import_start
+            metrics.set("elapsed_seconds", elapsed)
+            metrics.set("entries_per_second", (position - start) / elapsed if elapsed > 0 else 0.0)
+            metrics.save(args.metrics_file, args.metrics_format)
 
     print("Summary: {} entries retrieved -> {} new entries (i.e. not already in ADAPTABLE)".format(counter_all,
                                                                                                    counter_new))
-    print("All warning messages are saved in '{}'!".format(LOGFILE))
-
-
-
-
-
-
+    if args.incremental:
+        print("{} entries did not change since the previous import".format(counter_unchanged))
+    if merge_counts is not None:
+        print("Merge: {new} new entries, {updated} updated entries, {unchanged} unchanged entries".format(
+            **merge_counts))
+    if warning_collector.verbose:
+        print("All warning messages are saved in '{}'!".format(LOGFILE))
+    elif len(warning_collector) > 0:
+        print("A summary of the warnings is saved in '{}' (use --verbose-warnings to log all of them)".format(LOGFILE))
+    if listing_failed:
+        sys.exit(1)
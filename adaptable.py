@@ -1,5 +1,26 @@
 
 from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping, Sequence
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import gc
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import threading
+from types import MappingProxyType
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for Library.to_columns
+    np = None
 
 class Entry(object):
     _defined_properties = {
@@ -72,46 +93,55 @@ class Entry(object):
 
     nproperties_used = 65
 
+    _properties_by_name = {name: propid for propid, name in _defined_properties.items()}
+
+    # Properties are stored in a fixed-length list (index = property ID - 1), None standing for an empty property
+    __slots__ = ("sequence", "_values")
+
     def __init__(self, sequence, fasta_comment=None):
         self.sequence = sequence
-        self.properties = defaultdict(list)
-        self.nproperties = len(self.properties)
-        self._properties_by_name = dict(zip(self._defined_properties.values(), self._defined_properties.keys()))
+        self._values = [None] * self.nproperties_used
         if fasta_comment is not None:
             self.get_parameters_from_fasta(fasta_comment)
 
-        self.properties[2] = [sequence]
-
-    def to_fasta(self):
-        fasta = ">"
-
-        for i in range(self.nproperties_used):
-            prop_value = self.properties[i+1]
-            if len(prop_value) == 0:
-                fasta += "_"
-            else:
-                fasta += ";".join(prop_value)
+        self._values[1] = [sequence]
 
-                # make sure the property ends with ";"
-                fasta += ";"
+    def _get_values(self, propid):
+        values = self._values[propid - 1]
+        if values is None:
+            values = self._values[propid - 1] = []
+        return values
 
-            fasta += " "
+    @property
+    def properties(self):
+        """
+        Read-only copy of the non-empty properties indexed by property ID (a missing property is an empty tuple).
 
-        # remove trailing space
-        fasta = fasta.strip(" ")
+        It used to be the dict storing the properties: writes through it now fail (TypeError, AttributeError) instead
+        of being lost. Use entry[item] to add properties.
+        """
+        return MappingProxyType(defaultdict(tuple, ((i + 1, tuple(values))
+                                                    for i, values in enumerate(self._values) if values)))
 
-        fasta += "\n{}\n".format(self.sequence)
+    def to_fasta(self):
+        # Each property ends with ";" (or is "_" if empty)
+        return ">{}\n{}\n".format(" ".join(";".join(values) + ";" if values else "_" for values in self._values),
+                                   self.sequence)
 
-        return fasta
+    def as_stored(self):
+        """
+        :return: a copy of the entry as it is read back from its FASTA record (the values containing whitespace are
+        split into several fields, like in any library read from a file)
+        """
+        return Entry(self.sequence, self.to_fasta().split("\n", 1)[0])
 
     def as_human_readable(self):
         content = "ADAPTABLE Entry:\n"
 
-        for i in range(self.nproperties_used):
+        for i, prop_value in enumerate(self._values):
             prop_name = self._defined_properties[i+1]
-            prop_value = self.properties[i+1]
 
-            content += "  -> {}: {}\n".format(prop_name, "; ".join(prop_value))
+            content += "  -> {}: {}\n".format(prop_name, "; ".join(prop_value or []))
         return content
 
     def get_parameters_from_fasta(self, line):
@@ -119,22 +149,43 @@ class Entry(object):
             raise ValueError("FASTA line does not start with >")
         line = line[1:].split()
 
-        for propid, value in enumerate(line):
+        # Fields beyond the defined properties are ignored (they were never written back to FASTA anyway)
+        for propid, value in enumerate(line[:self.nproperties_used]):
             if value != "_":
-                value = value.split(";")
+                value = [val for val in value.split(";") if val != ""]
+
+                if self._values[propid] is None:
+                    self._values[propid] = value
+                else:
+                    self._values[propid].extend(value)
 
-                for val in value:
-                    if val != "":
-                        self.properties[propid+1].append(val)
+    def merge(self, other):
+        """
+        Add the property values of another entry (with the same sequence) that this entry does not have yet.
+
+        :return: True if the entry was modified
+        """
+        changed = False
+        for propid, values in enumerate(other._values):
+            if not values:
+                continue
+            current = self._values[propid]
+            if current is None:
+                current = self._values[propid] = []
+            known = set(current)
+            for value in values:
+                if value not in known:
+                    known.add(value)
+                    current.append(value)
+                    changed = True
+        return changed
 
     @property
     def name(self):
-        try:
-            name = self.properties[3][0]
-        except IndexError:
-            name = "UNKNOWN"
-
-        return name
+        values = self._values[2]
+        if values:
+            return values[0]
+        return "UNKNOWN"
 
     def __repr__(self):
         return "< Adaptable entry: {} - sequence: {} >".format(self.name, self.sequence)
@@ -144,32 +195,721 @@ class Entry(object):
 
     def __getitem__(self, item):
         if type(item) is int:
-            return self.properties[item]
+            if 1 <= item <= self.nproperties_used:
+                return self._get_values(item)
+            return []
         try:
-            return self.properties[self._properties_by_name[item]]
+            return self._get_values(self._properties_by_name[item])
         except KeyError:
             raise KeyError("No such property: {}".format(item))
 
 
+_character_replacements = [
+    ("\\xa0", " "),  # non-break space
+    ("\\x96", " "),  # start of guarded area
+    ("\\xb5", "µ"),  # µ character
+    ("\\xec", "µ"),  # µ character wrongly encoding as "ì"
+    ("\\xb1", "±"),   # ± character
+]
+
+
+def _replace_characters(line):
+    # Try to replace html-oriented characters
+    for bad, good in _character_replacements:
+        line = line.replace(bad, good)
+    return line
+
+
+def _get_encoding_warning(line):
+    if "\\" in line:
+        position = line.index("\\")
+        character = line[position:position+4]
+        return "the character '{}' is not encoded in utf-8 (representation in cp1252: '{}')".format(
+            character,
+            character.encode("cp1252").decode("unicode_escape")
+        )
+    return None
+
+
+def _format_warning(warning, lino=None):
+    if lino is None:
+        return "Warning: {}".format(warning)
+    return "Warning (line {}): {}".format(lino, warning)
+
+
+def _clean_fasta_line(line, lino=None):
+    line = _replace_characters(line)
+
+    warning = _get_encoding_warning(line)
+    if warning is not None:
+        print(_format_warning(warning, lino))
+    return line
+
+
+@contextmanager
+def _paused_gc():
+    # Millions of lists are allocated when entries are built in bulk: the cyclic garbage collector would keep
+    # scanning them for nothing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _split_fasta_file(fname, nchunks, encoding="utf-8"):
+    """
+    Split a FASTA file into byte ranges starting at a header line (so that each range can be parsed on its own).
+
+    :return: list of (start, end) offsets
+    """
+    size = os.path.getsize(fname)
+    boundaries = [0]
+    with open(fname, "rb") as fp:
+        for k in range(1, nchunks):
+            target = size * k // nchunks
+            if target <= boundaries[-1]:
+                continue
+
+            # Look for the first header line starting at or after the target offset
+            fp.seek(target - 1)
+            fp.readline()
+            while True:
+                position = fp.tell()
+                line = fp.readline()
+                if not line:
+                    position = size
+                    break
+                if line.decode(encoding, errors="backslashreplace").strip()[:1] == ">":
+                    break
+
+            if position >= size:
+                break
+            boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _read_fasta_chunk(fname, encoding, start, end):
+    """
+    Parse a range of a FASTA file (see Library.read), in a worker process.
+
+    :return: (number of lines, list of (sequence, property values) of the entries,
+              list of (line number in the range, warning))
+    """
+    with open(fname, "rb") as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode(encoding, errors="backslashreplace")
+
+    with _paused_gc():
+        records = []
+        warnings = []
+        interned = {}
+        fasta_comment = None
+        lino = 0
+        for lino, line in enumerate(io.StringIO(text, newline=None), 1):
+            line = line.strip()
+            if line == "":
+                continue
+
+            line = _replace_characters(line)
+            warning = _get_encoding_warning(line)
+            if warning is not None:
+                warnings.append((lino, warning))
+
+            if line[0] == ">":
+                fasta_comment = line
+            elif fasta_comment is not None:
+                values = Entry(line, fasta_comment)._values
+                # Repeated values are sent once to the parent process: pickle only serializes the same object once
+                for propid, prop_values in enumerate(values):
+                    if prop_values:
+                        values[propid] = [interned.setdefault(value, value) for value in prop_values]
+                records.append((interned.setdefault(line, line), values))
+                fasta_comment = None
+    return lino, records, warnings
+
+
+def _hash_sequence(sequence):
+    return int.from_bytes(hashlib.blake2b(sequence.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def save_iter(entries, fname, chunk_size=1000):
+    """
+    Write entries to an ADAPTABLE FASTA file without holding them in memory.
+
+    The records are written by chunks to a temporary file (UTF-8 encoded) which replaces the target file once
+    complete, so that an interrupted write never leaves a truncated database behind.
+
+    :param entries: any iterable of entries (e.g. a generator)
+    :param str fname: target file
+    :param int chunk_size: number of records formatted per write
+    :return: the number of entries written
+    """
+    return _write_fasta_records((entry.to_fasta() for entry in entries), fname, chunk_size=chunk_size)
+
+
+def _tee_stored_entries(records, entries):
+    """
+    Yield FASTA records, appending to entries the entry read back from each of them (as Library.read would).
+    """
+    for record in records:
+        header, sequence = record.rstrip("\n").split("\n")
+        entries.append(Entry(_replace_characters(sequence), _replace_characters(header)))
+        yield record
+
+
+def _get_tmp_fname(fname):
+    """
+    Name of the temporary file written before replacing `fname`, unique to the process and to the thread.
+    """
+    return "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+
+
+def _write_fasta_records(records, fname, chunk_size=1000):
+    """
+    Write FASTA records (see save_iter).
+
+    :return: the number of records written
+    """
+    tmp_fname = _get_tmp_fname(fname)
+    count = 0
+    try:
+        with open(tmp_fname, "w", encoding="utf-8", buffering=1024 * 1024) as fp:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    fp.write("".join(chunk))
+                    count += len(chunk)
+                    chunk = []
+            fp.write("".join(chunk))
+            count += len(chunk)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        try:
+            os.remove(tmp_fname)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+class LibraryIndex(object):
+    """
+    Offset index of an ADAPTABLE FASTA file: for each record, the offsets of its header and sequence lines and the
+    hash of its sequence.
+    """
+    magic = b"ADAPTIDX"
+    header_format = "<8sQQQ"
+
+    def __init__(self, header_offsets=None, sequence_offsets=None, sequence_hashes=None):
+        self.header_offsets = header_offsets if header_offsets is not None else array("q")
+        self.sequence_offsets = sequence_offsets if sequence_offsets is not None else array("q")
+        self.sequence_hashes = sequence_hashes if sequence_hashes is not None else array("Q")
+
+        # Hash lookup table (built on first use): hashes sorted along with their positions, 16 bytes per record
+        self._sorted_hashes = None
+        self._sorted_positions = None
+        self._duplicated_hashes = None
+
+    def __len__(self):
+        return len(self.sequence_offsets)
+
+    def _build_lookup(self):
+        order = sorted(range(len(self.sequence_hashes)), key=self.sequence_hashes.__getitem__)
+        self._sorted_positions = array("q", order)
+        self._sorted_hashes = array("Q", (self.sequence_hashes[position] for position in order))
+        self._duplicated_hashes = {sequence_hash for previous, sequence_hash in zip(self._sorted_hashes,
+                                                                                    self._sorted_hashes[1:])
+                                   if previous == sequence_hash}
+
+    def get_position(self, sequence_hash):
+        # Like the eager Library.entries dict, the last record wins when a sequence is duplicated (the sort is stable)
+        if self._sorted_hashes is None:
+            self._build_lookup()
+        i = bisect_right(self._sorted_hashes, sequence_hash)
+        if i == 0 or self._sorted_hashes[i - 1] != sequence_hash:
+            raise KeyError(sequence_hash)
+        return self._sorted_positions[i - 1]
+
+    def get_duplicated_hashes(self):
+        """
+        :return: the set of the hashes shared by several records
+        """
+        if self._sorted_hashes is None:
+            self._build_lookup()
+        return self._duplicated_hashes
+
+    def count_unique(self):
+        """
+        :return: the number of distinct sequence hashes
+        """
+        if self._sorted_hashes is None:
+            self._build_lookup()
+        return sum(1 for previous, sequence_hash in zip(self._sorted_hashes, self._sorted_hashes[1:])
+                   if previous != sequence_hash) + (1 if len(self._sorted_hashes) > 0 else 0)
+
+    @classmethod
+    def build(cls, buffer, encoding="utf-8"):
+        """
+        Index a FASTA file, printing the encoding warnings of its lines (only once: the lazy reads do not report them
+        again).
+        """
+        index = cls()
+        header_offset = None
+        position = 0
+        lino = 0
+        size = len(buffer)
+        while position < size:
+            end = buffer.find(b"\n", position)
+            if end == -1:
+                end = size
+            line = buffer[position:end].strip()
+            lino += 1
+
+            # Only lines with non-ASCII characters or backslashes can trigger an encoding warning
+            if b"\\" in line or not line.isascii():
+                warning = _get_encoding_warning(_replace_characters(line.decode(encoding, errors="backslashreplace")))
+                if warning is not None:
+                    print(_format_warning(warning, lino))
+
+            if len(line) > 0:
+                if line[:1] == b">":
+                    header_offset = position
+                elif header_offset is not None:
+                    sequence = line.decode(encoding, errors="backslashreplace").strip()
+                    for bad, good in _character_replacements:
+                        sequence = sequence.replace(bad, good)
+
+                    index.header_offsets.append(header_offset)
+                    index.sequence_offsets.append(position)
+                    index.sequence_hashes.append(_hash_sequence(sequence))
+                    header_offset = None
+            position = end + 1
+        return index
+
+    @classmethod
+    def load(cls, fname, source_fname):
+        """
+        Load a persisted index.
+
+        :return: the index or None if the index file does not exist or does not match the source file
+        """
+        stat = os.stat(source_fname)
+        try:
+            with open(fname, "rb") as fp:
+                magic, size, mtime, count = struct.unpack(cls.header_format, fp.read(struct.calcsize(cls.header_format)))
+                if magic != cls.magic or size != stat.st_size or mtime != stat.st_mtime_ns:
+                    return None
+
+                arrays = [array("q"), array("q"), array("Q")]
+                for values in arrays:
+                    values.fromfile(fp, count)
+                    if sys.byteorder != "little":
+                        values.byteswap()
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(*arrays)
+
+    def save(self, fname, source_fname):
+        stat = os.stat(source_fname)
+        with open(fname, "wb") as fp:
+            fp.write(struct.pack(self.header_format, self.magic, stat.st_size, stat.st_mtime_ns, len(self)))
+            for values in (self.header_offsets, self.sequence_offsets, self.sequence_hashes):
+                if sys.byteorder != "little":
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                values.tofile(fp)
+
+
+def _get_file_checksum(fname):
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(fname, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            checksum.update(block)
+    return checksum.digest()
+
+
+class LibrarySnapshot(object):
+    """
+    Binary snapshot of a library, used as a cache of its FASTA file (which remains the interchange format).
+
+    Layout (little-endian), after the header:
+    - string_offsets (uint64, nstrings + 1): offsets of the interned strings in the decoded text,
+    - entry_offsets (uint32, nentries + 1): range of each entry in the property arrays,
+    - sequence_ids (uint32, nentries): string ID of each sequence,
+    - property_counts (uint32, nproperties): number of values of each non-empty property,
+    - value_ids (uint32, nvalues): string ID of each value,
+    - property_ids (uint8, nproperties): index of each non-empty property,
+    - text (UTF-8): all the distinct strings, concatenated.
+    The arrays are read from a memory map without being copied; the header holds the checksum of the source file.
+    """
+    magic = b"ADAPTSNP"
+    version = 1
+    header_format = "<8sI4xQ16sQQQQQ"
+
+    @classmethod
+    def dump(cls, entries, fname, source_fname):
+        string_ids = {}
+        strings = []
+        string_offsets = array("Q", [0])
+        entry_offsets = array("I", [0])
+        sequence_ids = array("I")
+        property_counts = array("I")
+        value_ids = array("I")
+        property_ids = array("B")
+
+        def intern(value):
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = string_ids[value] = len(strings)
+                strings.append(value)
+                string_offsets.append(string_offsets[-1] + len(value))
+            return string_id
+
+        for entry in entries:
+            sequence_ids.append(intern(entry.sequence))
+            for propid, values in enumerate(entry._values):
+                # The 'sequence' property is rebuilt from the sequence
+                if not values or propid == 1:
+                    continue
+                property_ids.append(propid)
+                property_counts.append(len(values))
+                value_ids.extend(intern(value) for value in values)
+            entry_offsets.append(len(property_ids))
+
+        arrays = (string_offsets, entry_offsets, sequence_ids, property_counts, value_ids, property_ids)
+        text = "".join(strings).encode("utf-8")
+
+        tmp_fname = _get_tmp_fname(fname)
+        try:
+            with open(tmp_fname, "wb") as fp:
+                fp.write(struct.pack(cls.header_format, cls.magic, cls.version, os.stat(source_fname).st_size,
+                                     _get_file_checksum(source_fname), len(strings), len(sequence_ids),
+                                     len(property_ids), len(value_ids), len(text)))
+                for values in arrays:
+                    if sys.byteorder != "little":
+                        values = array(values.typecode, values)
+                        values.byteswap()
+                    values.tofile(fp)
+                fp.write(text)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            try:
+                os.remove(tmp_fname)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def load(cls, fname, source_fname):
+        """
+        Load the entries of a snapshot.
+
+        :return: the list of entries or None if the snapshot does not exist or does not match the source file
+        """
+        header_size = struct.calcsize(cls.header_format)
+        try:
+            with open(fname, "rb") as fp:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        with buffer:
+            try:
+                magic, version, source_size, checksum, nstrings, nentries, nproperties, nvalues, text_size = \
+                    struct.unpack_from(cls.header_format, buffer)
+            except struct.error:
+                return None
+            if magic != cls.magic or version != cls.version:
+                return None
+            try:
+                if source_size != os.stat(source_fname).st_size or checksum != _get_file_checksum(source_fname):
+                    return None
+            except OSError:
+                return None
+
+            offset = header_size
+            arrays = []
+            for typecode, count in (("Q", nstrings + 1), ("I", nentries + 1), ("I", nentries), ("I", nproperties),
+                                    ("I", nvalues), ("B", nproperties)):
+                size = array(typecode).itemsize * count
+                if sys.byteorder == "little":
+                    values = memoryview(buffer)[offset:offset + size].cast(typecode)
+                else:
+                    values = array(typecode, buffer[offset:offset + size])
+                    values.byteswap()
+                arrays.append(values)
+                offset += size
+            if offset + text_size != len(buffer):
+                for values in arrays:
+                    if isinstance(values, memoryview):
+                        values.release()
+                return None
+            text = buffer[offset:offset + text_size].decode("utf-8")
+
+            string_offsets, entry_offsets, sequence_ids, property_counts, value_ids, property_ids = \
+                [values.tolist() for values in arrays]
+            strings = [text[start:end] for start, end in zip(string_offsets, string_offsets[1:])]
+            # Interned values: all the occurrences of a value are the same string object
+            value_strings = list(map(strings.__getitem__, value_ids))
+            sequences = list(map(strings.__getitem__, sequence_ids))
+
+            with _paused_gc():
+                entries = []
+                nproperties_used = Entry.nproperties_used
+                value_position = 0
+                for i, sequence in enumerate(sequences):
+                    values = [None] * nproperties_used
+                    values[1] = [sequence]
+                    for position in range(entry_offsets[i], entry_offsets[i + 1]):
+                        end = value_position + property_counts[position]
+                        values[property_ids[position]] = value_strings[value_position:end]
+                        value_position = end
+
+                    entry = Entry.__new__(Entry)
+                    entry.sequence = sequence
+                    entry._values = values
+                    entries.append(entry)
+
+            for values in arrays:
+                if isinstance(values, memoryview):
+                    values.release()
+        return entries
+
+
+class _LazyEntries(MutableMapping):
+    """
+    sequence -> Entry mapping of a lazy Library. Entries are built from the file when accessed and are not kept in
+    memory: modified entries must be assigned back to be taken into account.
+    """
+    def __init__(self, library):
+        self._library = library
+        self._added = OrderedDict()
+        self._deleted = set()
+
+    def __getitem__(self, sequence):
+        if sequence in self._added:
+            return self._added[sequence]
+        if sequence in self._deleted:
+            raise KeyError(sequence)
+
+        index = self._library.index
+        try:
+            position = index.get_position(_hash_sequence(sequence))
+        except KeyError:
+            raise KeyError(sequence)
+        entry = self._library._read_entry(position)
+        if entry.sequence != sequence:
+            raise KeyError(sequence)
+        return entry
+
+    def __setitem__(self, sequence, entry):
+        self._deleted.discard(sequence)
+        self._added[sequence] = entry
+
+    def __delitem__(self, sequence):
+        if sequence in self._added:
+            del self._added[sequence]
+            if not self._in_file(sequence):
+                return
+        elif not self._in_file(sequence):
+            raise KeyError(sequence)
+        self._deleted.add(sequence)
+
+    def _in_file(self, sequence):
+        try:
+            return self._library._read_sequence(self._library.index.get_position(_hash_sequence(sequence))) == sequence
+        except KeyError:
+            return False
+
+    def iter_fasta_records(self):
+        """
+        FASTA records of the entries, in iteration order: the records of the entries that were not modified are copied
+        from the file as they are (the FASTA format does not preserve the values containing whitespace)
+        """
+        library = self._library
+        for sequence in self:
+            if sequence in self._added:
+                yield self._added[sequence].to_fasta()
+                continue
+
+            position = library.index.get_position(_hash_sequence(sequence))
+            record = "{}\n{}\n".format(library._read_line(library.index.header_offsets[position]),
+                                        library._read_line(library.index.sequence_offsets[position]))
+            # Lines that are not valid UTF-8 are rewritten with the characters replaced, as by Entry.to_fasta
+            if "\\" in record:
+                record = library._read_entry(position).to_fasta()
+            yield record
+
+    def _iter_file_sequences(self):
+        # Only the (rare) duplicated sequences have to be tracked to yield each sequence once
+        duplicated = self._library.index.get_duplicated_hashes()
+        seen = set()
+        for position, sequence_hash in enumerate(self._library.index.sequence_hashes):
+            if sequence_hash in duplicated:
+                if sequence_hash in seen:
+                    continue
+                seen.add(sequence_hash)
+            yield self._library._read_sequence(position)
+
+    def __iter__(self):
+        for sequence in self._iter_file_sequences():
+            if sequence not in self._deleted:
+                yield sequence
+        for sequence in self._added:
+            if not self._in_file(sequence):
+                yield sequence
+
+    def __len__(self):
+        nadded = sum(1 for sequence in self._added if not self._in_file(sequence))
+        return self._library.index.count_unique() - len(self._deleted) + nadded
+
+
+class _LazyEntriesList(Sequence):
+    """
+    Positional view of a lazy Library: entries are built from the file when accessed.
+    """
+    def __init__(self, library):
+        self._library = library
+        self._appended = []
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        nfile = len(self._library.index)
+        if item < 0 or item >= nfile + len(self._appended):
+            raise IndexError("Library index out of range")
+        if item < nfile:
+            return self._library._read_entry(item)
+        return self._appended[item - nfile]
+
+    def __len__(self):
+        return len(self._library.index) + len(self._appended)
+
+    def append(self, entry):
+        self._appended.append(entry)
+
+
+class PropertyIndexes(object):
+    """
+    Secondary indexes of a Library, mapping to sets of sequences:
+    - the presence of each property,
+    - the values of the indexed properties (ID is always indexed),
+    - the tokens of the IDs: prefix (e.g. 'pfam' for 'pfamPF00001') and accession (e.g. 'PF00001').
+    """
+    id_prefixes = ("uniprot", "supfam", "pfam", "pmp", "tigrfams", "hamap", "prosite", "pirsf", "cdd", "prodom", "smr")
+    _id_prefix_pattern = re.compile("^({}|[a-z]+)(.+)$".format(
+        "|".join(sorted(id_prefixes, key=len, reverse=True))))
+
+    def __init__(self, indexed_properties=()):
+        self.indexed_properties = ("ID",) + tuple(name for name in indexed_properties if name != "ID")
+        for name in self.indexed_properties:
+            if name not in Entry._properties_by_name:
+                raise KeyError("No such property: {}".format(name))
+
+        self.presence = {name: set() for name in Entry._properties_by_name}
+        self.values = {name: defaultdict(set) for name in self.indexed_properties}
+        self.id_prefixes_index = defaultdict(set)
+        self.accessions_index = defaultdict(set)
+        self.positions = {}
+
+    def _iter_postings(self, entry):
+        for propid, values in enumerate(entry._values):
+            if values:
+                yield self.presence[Entry._defined_properties[propid + 1]]
+        for name in self.indexed_properties:
+            for value in entry[name]:
+                yield self.values[name][value]
+        for value in entry["ID"]:
+            match = self._id_prefix_pattern.match(value)
+            if match is not None:
+                yield self.id_prefixes_index[match.group(1)]
+                yield self.accessions_index[match.group(2)]
+
+    def add(self, entry):
+        if entry.sequence not in self.positions:
+            self.positions[entry.sequence] = len(self.positions)
+        for postings in self._iter_postings(entry):
+            postings.add(entry.sequence)
+
+    def remove(self, entry):
+        for postings in self._iter_postings(entry):
+            postings.discard(entry.sequence)
+
+    def find(self, has=(), id_prefix=None, accession=None, **values):
+        """
+        :return: the set of sequences matching the indexed criteria and the criteria that are not indexed
+        """
+        candidates = []
+        for name in has:
+            try:
+                candidates.append(self.presence[name])
+            except KeyError:
+                raise KeyError("No such property: {}".format(name))
+        if id_prefix is not None:
+            candidates.append(self.id_prefixes_index.get(id_prefix, set()))
+        if accession is not None:
+            candidates.append(self.accessions_index.get(accession, set()))
+
+        remaining = {}
+        for name, value in values.items():
+            if name in self.values:
+                candidates.append(self.values[name].get(value, set()))
+            else:
+                remaining[name] = value
+
+        if len(candidates) == 0:
+            return set(self.positions), remaining
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:]), remaining
+
+
 class Library(object):
-    def __init__(self, fname=None, encoding="utf-8"):
+    def __init__(self, fname=None, encoding="utf-8", lazy=False, indexed_properties=None):
         self.fname = fname
         self.encoding = encoding
+        self.lazy = lazy
 
         self.entries = OrderedDict()
         self.entries_list = []
 
-    def read(self):
-        character_replacements = [
-            ("\\xa0", " "),  # non-break space
-            ("\\x96", " "),  # start of guarded area
-            ("\\xb5", "µ"),  # µ character
-            ("\\xec", "µ"),  # µ character wrongly encoding as "ì"
-            ("\\xb1", "±"),   # ± character
-        ]
+        # Secondary indexes (see Library.query)
+        self.indexes = None
+        if indexed_properties is not None:
+            self.indexes = PropertyIndexes(indexed_properties)
+
+        self.index = None
+        self._fp = None
+        self._buffer = None
+
+    def read(self, processes=0, chunk_size=16 * 1024 * 1024):
+        """
+        Read the FASTA file (or only index it for a lazy library).
+
+        :param int processes: number of worker processes used to parse the file (0 to parse it in this process). The
+                              entries are identical to the ones read serially.
+        :param int chunk_size: approximate size (in bytes) of the parts of the file parsed by each worker task
+        """
         if self.fname is None:
             raise ValueError("No filename defined. Please set the 'fname' attribute")
 
+        if self.lazy:
+            self._read_index()
+            return
+
+        if processes > 0:
+            self._read_parallel(processes, chunk_size)
+            return
+
         with open(self.fname, encoding=self.encoding, errors="backslashreplace") as fp:
             sequence = None
             fasta_comment = None
@@ -179,17 +919,7 @@ class Library(object):
                 if line == "":
                     continue
 
-                # Try to replace html-oriented characters
-                for bad, good in character_replacements:
-                    line = line.replace(bad, good)
-
-                if "\\" in line:
-                    position = line.index("\\")
-                    character = line[position:position+4]
-                    print("Warning: the character '{}' is not encoded in utf-8 (representation in cp1252: '{}')".format(
-                        character,
-                        character.encode("cp1252").decode("unicode_escape")
-                    ))
+                line = _clean_fasta_line(line, lino + 1)
 
                 if line[0] == ">":
                     fasta_comment = line
@@ -199,26 +929,360 @@ class Library(object):
 
                     fasta_comment = None
 
-                    self.entries[sequence] = entry
-                    self.entries_list.append(entry)
+                    self.add(entry)
 
                     sequence = None
 
             print("{} lines read -> {} entries loaded\n".format(lino+1, len(self.entries)))
 
-    def save(self, fname=None, verbose=True):
+    def _read_parallel(self, processes, chunk_size):
+        nchunks = max(processes, os.path.getsize(self.fname) // chunk_size + 1)
+        ranges = _split_fasta_file(self.fname, nchunks, self.encoding)
+
+        nlines = 0
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        with _paused_gc(), executor:
+            # The chunks are merged in file order: entries and warnings come out as with the serial reader
+            for chunk_nlines, records, warnings in executor.map(_read_fasta_chunk, *zip(*(
+                    (self.fname, self.encoding, start, end) for start, end in ranges))):
+                for lino, warning in warnings:
+                    print(_format_warning(warning, nlines + lino))
+                for sequence, values in records:
+                    entry = Entry.__new__(Entry)
+                    entry.sequence = sequence
+                    entry._values = values
+                    self.add(entry)
+                nlines += chunk_nlines
+
+        print("{} lines read -> {} entries loaded\n".format(nlines, len(self.entries)))
+
+    def _read_index(self):
+        self.close()
+        self._fp = open(self.fname, "rb")
+        if os.fstat(self._fp.fileno()).st_size > 0:
+            self._buffer = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._buffer = b""
+
+        index_fname = self.get_index_fname()
+        self.index = LibraryIndex.load(index_fname, self.fname)
+        if self.index is None:
+            self.index = LibraryIndex.build(self._buffer, self.encoding)
+            try:
+                self.index.save(index_fname, self.fname)
+            except OSError:
+                pass
+
+        self.entries = _LazyEntries(self)
+        self.entries_list = _LazyEntriesList(self)
+
+        if self.indexes is not None:
+            self.indexes = PropertyIndexes(self.indexes.indexed_properties)
+            for entry in self.entries.values():
+                self.indexes.add(entry)
+
+        print("{} entries indexed\n".format(len(self.index)))
+
+    def get_index_fname(self):
+        return "{}.idx".format(self.fname)
+
+    def get_snapshot_fname(self):
+        return "{}.snapshot".format(self.fname)
+
+    def dump_snapshot(self, fname=None):
+        """
+        Save the FASTA file of the library to a binary snapshot (see load_snapshot). The entries are read from the file:
+        the changes that are not saved yet are not in the snapshot (see save to write both at once).
+
+        :param str fname: snapshot file (default: <fname>.snapshot)
+        """
+        if self.fname is None:
+            raise ValueError("No filename defined. Please set the 'fname' attribute")
+        if fname is None:
+            fname = self.get_snapshot_fname()
+
+        stored = Library(self.fname, encoding=self.encoding)
+        stored.read()
+        LibrarySnapshot.dump(stored.entries_list, fname, self.fname)
+
+    def load_snapshot(self, fname=None, rebuild=True):
+        """
+        Load the library from its binary snapshot instead of parsing the FASTA file. If the snapshot is missing or
+        does not match the FASTA file anymore, the FASTA file is read instead (and the snapshot is rebuilt).
+
+        :param str fname: snapshot file (default: <fname>.snapshot)
+        :param bool rebuild: rebuild a missing or stale snapshot
+        :return: True if the library was loaded from the snapshot
+        """
+        if self.fname is None:
+            raise ValueError("No filename defined. Please set the 'fname' attribute")
+        if self.lazy:
+            raise ValueError("A lazy library is read from its FASTA file")
+        if fname is None:
+            fname = self.get_snapshot_fname()
+
+        entries = LibrarySnapshot.load(fname, self.fname)
+        if entries is None:
+            self.read()
+            if rebuild:
+                # The entries were just read from the file
+                LibrarySnapshot.dump(self.entries_list, fname, self.fname)
+            return False
+
+        for entry in entries:
+            self.add(entry)
+        print("{} entries loaded from snapshot\n".format(len(self.entries)))
+        return True
+
+    def _read_line(self, offset):
+        end = self._buffer.find(b"\n", offset)
+        if end == -1:
+            end = len(self._buffer)
+        return self._buffer[offset:end].decode(self.encoding, errors="backslashreplace").strip()
+
+    # The encoding warnings are printed when the file is indexed, not on each (possibly repeated) lazy read
+    def _read_sequence(self, position):
+        return _replace_characters(self._read_line(self.index.sequence_offsets[position]))
+
+    def _read_entry(self, position):
+        fasta_comment = _replace_characters(self._read_line(self.index.header_offsets[position]))
+        return Entry(self._read_sequence(position), fasta_comment)
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def save(self, fname=None, verbose=True, snapshot=False):
+        """
+        :param str fname: FASTA file (default: the file of the library)
+        :param bool verbose: be verbose
+        :param bool snapshot: also save the binary snapshot of the file (<fname>.snapshot, see load_snapshot), built
+                              from the saved records
+        """
         if fname is None:
             fname = self.fname
 
-        with open(fname, "w") as fp:
-            for entry in self.entries.values():
-                fp.write(entry.to_fasta())
+        if self.lazy and self._fp is not None:
+            records = self.entries.iter_fasta_records()
+        else:
+            records = (entry.to_fasta() for entry in self.entries.values())
+
+        stored = []
+        if snapshot:
+            records = _tee_stored_entries(records, stored)
+        _write_fasta_records(records, fname)
+        if snapshot:
+            LibrarySnapshot.dump(stored, "{}.snapshot".format(fname), fname)
+
+        # The file a lazy library is read from was replaced: index the new one
+        if self.lazy and self._fp is not None and os.path.abspath(fname) == os.path.abspath(self.fname):
+            self._read_index()
 
         if verbose:
             print("Library saved to '{}'".format(fname))
 
+    def add(self, entry):
+        """
+        Add an entry to the library (replacing the entry with the same sequence, if any) and update the secondary
+        indexes. An entry modified after being added must be added again for the indexes to be up to date.
+        """
+        if self.indexes is not None:
+            previous = self.entries.get(entry.sequence)
+            if previous is not None:
+                self.indexes.remove(previous)
+            self.indexes.add(entry)
+
+        self.entries[entry.sequence] = entry
+        self.entries_list.append(entry)
+
+    def merge(self, entries, callback=None, as_stored=False):
+        """
+        Merge entries into the library: the property values of the entries whose sequence is already in the library
+        are added to the existing entry (without duplicates), the other entries are added as new entries.
+
+        With a lazy library, only the new and updated entries are kept in memory, so that a large library can be
+        updated and saved to another file (the records of the other entries are copied as they are).
+
+        :param entries: iterable of entries
+        :param callback: called with each entry and its status ('new', 'updated' or 'unchanged')
+        :param bool as_stored: the entries of the library were read from a FASTA file: compare the entries to them as
+                               they would be read back from their FASTA records (see Entry.as_stored), so that an
+                               entry already saved is 'unchanged'. New entries are added as they are.
+        :return: dict status -> number of entries
+        """
+        counts = {"new": 0, "updated": 0, "unchanged": 0}
+        for entry in entries:
+            current = self.entries.get(entry.sequence)
+            if current is None:
+                self.add(entry)
+                status = "new"
+            else:
+                if self.indexes is not None:
+                    self.indexes.remove(current)
+                changed = current.merge(entry.as_stored() if as_stored else entry)
+                if self.indexes is not None:
+                    self.indexes.add(current)
+
+                if changed:
+                    # Needed by lazy libraries whose entries are not kept in memory
+                    self.entries[current.sequence] = current
+                    status = "updated"
+                else:
+                    status = "unchanged"
+
+            counts[status] += 1
+            if callback is not None:
+                callback(entry, status)
+        return counts
+
+    def query(self, has=(), id_prefix=None, accession=None, **values):
+        """
+        Find the entries matching all the criteria, using the secondary indexes if the library has some.
+
+        :param has: names of the properties the entries must have (e.g. ("pdb",))
+        :param str id_prefix: the entries must have an ID with this prefix (e.g. "pfam")
+        :param str accession: the entries must have an ID with this accession, whatever the database (e.g. "P12345")
+        :param values: property name -> value the property must contain (e.g. ID="uniprotP12345")
+        :return: list of matching entries, in the order they were added
+        """
+        if self.indexes is None:
+            indexes = PropertyIndexes()
+            for entry in self.entries.values():
+                indexes.add(entry)
+        else:
+            indexes = self.indexes
+
+        sequences, remaining = indexes.find(has, id_prefix, accession, **values)
+
+        matches = []
+        for sequence in sorted(sequences, key=indexes.positions.__getitem__):
+            entry = self.entries[sequence]
+            if all(value in entry[name] for name, value in remaining.items()):
+                matches.append(entry)
+        return matches
+
+    def to_columns(self, categorical_fields=("source", "taxonomy", "Family")):
+        """
+        Build a columnar (NumPy) view of the library to filter it using vectorized operations.
+
+        :param categorical_fields: names of the properties whose values are interned as categorical codes
+        :return: LibraryColumns
+        """
+        return LibraryColumns(self, categorical_fields)
+
     def __getitem__(self, item):
         if type(item) == int:
             return self.entries_list[item]
         else:
-            return self.entries[item]
\ No newline at end of file
+            return self.entries[item]
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LibraryColumns(object):
+    """
+    Columnar view of a Library. Row i corresponds to the i-th entry yielded when iterating over the library.
+
+    - flags: boolean matrix (nentries x 65) telling which properties are present
+    - lengths: sequence lengths
+    - for each categorical field, the interned values (categories) and the (row, code) pairs of the entries' values
+
+    Example:
+        columns = library.to_columns()
+        mask = (columns.has("antimicrobial") & columns.has("antifungal") & (columns.lengths < 30) &
+                columns.contains("source", "Homo sapiens"))
+        sub_library = columns.subset(mask)
+    """
+    def __init__(self, library, categorical_fields=("source", "taxonomy", "Family")):
+        if np is None:
+            raise ImportError("NumPy is required to build a columnar view of a library")
+
+        self.library = library
+        self.categorical_fields = tuple(categorical_fields)
+
+        nproperties = Entry.nproperties_used
+        flags = bytearray()
+        lengths = []
+        field_ids = [Entry._properties_by_name[name] - 1 for name in self.categorical_fields]
+        self.categories = {name: [] for name in self.categorical_fields}
+        category_codes = {name: {} for name in self.categorical_fields}
+        value_rows = {name: [] for name in self.categorical_fields}
+        value_codes = {name: [] for name in self.categorical_fields}
+
+        for row, entry in enumerate(library):
+            flags.extend(1 if values else 0 for values in entry._values)
+            lengths.append(len(entry.sequence))
+
+            for name, field_id in zip(self.categorical_fields, field_ids):
+                codes = category_codes[name]
+                for value in entry._values[field_id] or []:
+                    code = codes.get(value)
+                    if code is None:
+                        code = codes[value] = len(codes)
+                        self.categories[name].append(value)
+                    value_rows[name].append(row)
+                    value_codes[name].append(code)
+
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.flags = np.frombuffer(bytes(flags), dtype=np.bool_).reshape(len(lengths), nproperties)
+        self.value_rows = {name: np.array(rows, dtype=np.int64) for name, rows in value_rows.items()}
+        self.value_codes = {name: np.array(codes, dtype=np.int64) for name, codes in value_codes.items()}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def has(self, name):
+        """
+        :return: boolean mask of the entries having the property
+        """
+        try:
+            return self.flags[:, Entry._properties_by_name[name] - 1]
+        except KeyError:
+            raise KeyError("No such property: {}".format(name))
+
+    def _get_mask_from_codes(self, name, codes):
+        if name not in self.value_codes:
+            raise KeyError("'{}' is not a categorical field of this view".format(name))
+        mask = np.zeros(len(self), dtype=np.bool_)
+        mask[self.value_rows[name][np.isin(self.value_codes[name], codes)]] = True
+        return mask
+
+    def equals(self, name, value):
+        """
+        :return: boolean mask of the entries with `value` among the values of the categorical field `name`
+        """
+        return self._get_mask_from_codes(name, [code for code, category in enumerate(self.categories[name])
+                                                if category == value])
+
+    def contains(self, name, substring):
+        """
+        :return: boolean mask of the entries with a value of the categorical field `name` containing `substring`
+        """
+        return self._get_mask_from_codes(name, [code for code, category in enumerate(self.categories[name])
+                                                if substring in category])
+
+    def indices(self, mask):
+        """
+        :return: row indices of the entries selected by the mask
+        """
+        return np.flatnonzero(mask)
+
+    def subset(self, mask):
+        """
+        :return: a new Library with the entries selected by the mask
+        """
+        mask = np.asarray(mask, dtype=np.bool_)
+        library = Library(encoding=self.library.encoding)
+        for selected, entry in zip(mask, self.library):
+            if selected:
+                library.entries[entry.sequence] = entry
+                library.entries_list.append(entry)
+        return library
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Deterministic generators of synthetic Unitprot XML entries and ADAPTABLE FASTA libraries.
+
+Entry `i` generated with a given seed is always the same, so that the stand-in server can build any entry on demand
+and the benchmark data can be regenerated identically across runs.
+"""
+import gzip
+import os
+import random
+import sys
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from adaptable import Entry, save_iter
+
+UNIPROT_NAMESPACE = "http://uniprot.org/uniprot"
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+ORGANISMS = [
+    ("Homo sapiens", "9606"),
+    ("Mus musculus", "10090"),
+    ("Hyalophora cecropia", "7123"),
+    ("Bombyx mori", "7091"),
+    ("Xenopus laevis", "8355"),
+    ("Apis mellifera", "7460"),
+    ("Rana temporaria", "8407"),
+    ("Escherichia coli", "562"),
+]
+
+# (ID, name): the first ones are mapped to ADAPTABLE bioproperties, the others are not
+KEYWORDS = [
+    ("KW-0929", "Antimicrobial"),
+    ("KW-0044", "Antibiotic"),
+    ("KW-0081", "Bacteriolytic enzyme"),
+    ("KW-0295", "Fungicide"),
+    ("KW-0930", "Antiviral protein"),
+    ("KW-0043", "Tumor suppressor"),
+    ("KW-0027", "Amidation"),
+    ("KW-0165", "Cleavage on pair of basic residues"),
+    ("KW-0964", "Secreted"),
+    ("KW-0732", "Signal"),
+    ("KW-0800", "Toxin"),
+    ("KW-1185", "Reference proteome"),
+]
+
+# Comments, some of them containing the text keywords looked for by the importer
+COMMENTS = [
+    ("function", "Has antibacterial activity against gram-positive and gram-negative bacteria."),
+    ("function", "Shows weak hemolytic activity on human erythrocytes."),
+    ("function", "Antifungal and antiviral activity in vitro."),
+    ("function", "Potent insecticidal toxin, cytotoxic to tumor cell lines."),
+    ("function", "Inhibits the growth of Plasmodium falciparum and Leishmania major parasites."),
+    ("subcellular location", "Secreted."),
+    ("tissue specificity", "Expressed by the skin glands."),
+    ("similarity", "Belongs to the cecropin family."),
+    ("mass spectrometry", "The measured mass is consistent with an amidated C-terminus."),
+]
+
+# (type, ID pattern): stored as IDs, stored as PDB, ignored and unknown databases
+DATABASES = [
+    ("Pfam", "PF{:05d}"),
+    ("SUPFAM", "SSF{:05d}"),
+    ("PROSITE", "PS{:05d}"),
+    ("InterPro", "IPR{:06d}"),
+    ("PDB", "{:d}ABC"),
+    ("GO", "GO:{:07d}"),
+    ("EMBL", "X{:05d}"),
+    ("RefSeq", "NP_{:06d}"),
+    ("PRIDE", "P{:05d}"),
+]
+
+FAMILIES = ["Cecropin", "Defensin", "Magainin", "Cathelicidin", "Bombinin", "Temporin", "Melittin"]
+
+
+def get_accession(i):
+    return "S{:07d}".format(i)
+
+
+def get_index_from_accession(accession):
+    """
+    :return: the index of a generated entry or None if the accession is not the one of a generated entry
+    """
+    if len(accession) != 8 or accession[0] != "S" or not accession[1:].isdigit():
+        return None
+    return int(accession[1:])
+
+
+def _get_random(i, seed):
+    return random.Random(seed * 1000003 + i)
+
+
+def generate_sequence(rng, min_length=10, max_length=50):
+    return "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(min_length, max_length)))
+
+
+def generate_uniprot_entry_xml(i, seed=0):
+    """
+    Generate the <entry> element of a Unitprot XML document (in the default Unitprot namespace).
+
+    :param int i: index of the entry
+    :param int seed: seed of the data set
+    :return: str
+    """
+    rng = _get_random(i, seed)
+    accession = get_accession(i)
+    sequence = generate_sequence(rng)
+    organism, taxonomy_id = rng.choice(ORGANISMS)
+    family = rng.choice(FAMILIES)
+
+    lines = ['<entry dataset="Swiss-Prot" created="2001-01-01" modified="2019-02-13" version="{}">'.format(
+        100 + rng.randrange(50))]
+    lines.append("<accession>{}</accession>".format(accession))
+    if rng.random() < 0.3:
+        lines.append("<accession>T{:07d}</accession>".format(i))
+    lines.append("<name>{}{}_{}</name>".format(family.upper()[:4], i % 10, organism.split()[0].upper()[:5]))
+    lines.append("<protein><recommendedName><fullName>{}-{}</fullName></recommendedName></protein>".format(
+        family, i))
+    lines.append('<gene><name type="primary">{}{}</name></gene>'.format(family[:3].upper(), i % 100))
+    lines.append('<organism><name type="scientific">{}</name><dbReference type="NCBI Taxonomy" id="{}"/>'
+                 '<lineage><taxon>Eukaryota</taxon><taxon>Metazoa</taxon></lineage></organism>'.format(
+                     escape(organism), taxonomy_id))
+
+    for k in range(rng.randint(1, 3)):
+        lines.append('<reference key="{}"><citation type="journal article" date="{}"><title>{}</title>'
+                     '<dbReference type="PubMed" id="{}"/></citation></reference>'.format(
+                         k + 1, 1980 + rng.randrange(40),
+                         escape("Isolation and characterization of {} peptides".format(family.lower())),
+                         rng.randrange(1000000, 40000000)))
+
+    for comment_type, text in rng.sample(COMMENTS, rng.randint(1, 4)):
+        lines.append('<comment type={}><text evidence="1">{}</text></comment>'.format(quoteattr(comment_type),
+                                                                                      escape(text)))
+
+    for dbtype, pattern in rng.sample(DATABASES, rng.randint(2, len(DATABASES))):
+        if dbtype == "PDB":
+            lines.append('<dbReference type="PDB" id="{}"><property type="method" value="NMR"/></dbReference>'.format(
+                pattern.format(rng.randrange(10))))
+        else:
+            lines.append('<dbReference type="{}" id="{}"/>'.format(dbtype, pattern.format(rng.randrange(100000))))
+
+    for keyword_id, keyword_name in sorted(rng.sample(KEYWORDS, rng.randint(1, 5))):
+        lines.append('<keyword id="{}">{}</keyword>'.format(keyword_id, escape(keyword_name)))
+
+    lines.append('<feature type="peptide" description="{}-{}"><location><begin position="1"/>'
+                 '<end position="{}"/></location></feature>'.format(family, i, len(sequence)))
+    lines.append('<evidence type="ECO:0000269" key="1"/>')
+    lines.append('<sequence length="{}" mass="{}" checksum="{:016X}" modified="2001-01-01" version="1">\n{}\n'
+                 '</sequence>'.format(len(sequence), 110 * len(sequence), rng.getrandbits(64), sequence))
+    lines.append("</entry>")
+    return "\n".join(lines)
+
+
+def generate_uniprot_document(indices, seed=0):
+    """
+    Generate a Unitprot XML document with the given entries (as returned by the Unitprot server).
+
+    :param indices: iterable of entry indices
+    :return: str
+    """
+    return "".join(_iter_uniprot_document(indices, seed))
+
+
+def _iter_uniprot_document(indices, seed=0):
+    yield ("<?xml version='1.0' encoding='UTF-8'?>\n"
+           '<uniprot xmlns="{}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+           'xsi:schemaLocation="http://uniprot.org/uniprot http://www.uniprot.org/support/docs/uniprot.xsd">\n'.format(
+               UNIPROT_NAMESPACE))
+    for i in indices:
+        yield generate_uniprot_entry_xml(i, seed)
+        yield "\n"
+    yield "<copyright>\nCopyrighted by the UniProt Consortium\n</copyright>\n</uniprot>"
+
+
+def write_uniprot_xml_dump(fname, nentries, seed=0):
+    """
+    Write a Unitprot XML dump of `nentries` entries (gzipped if fname ends with .gz).
+    """
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "wt", encoding="utf-8") as fp:
+        for chunk in _iter_uniprot_document(range(nentries), seed):
+            fp.write(chunk)
+
+
+def generate_adaptable_entry(i, seed=0):
+    """
+    Generate an ADAPTABLE entry (property values without spaces, so that it survives a FASTA round trip).
+    """
+    rng = _get_random(i, seed)
+    entry = Entry(generate_sequence(rng))
+    organism, taxonomy_id = rng.choice(ORGANISMS)
+    family = rng.choice(FAMILIES)
+
+    entry["ID"].append("uniprot{}".format(get_accession(i)))
+    for dbtype, pattern in rng.sample(DATABASES[:3], rng.randint(0, 3)):
+        entry["ID"].append("{}{}".format(dbtype.lower(), pattern.format(rng.randrange(100000))))
+    entry["name"].append("{}-{}".format(family, i))
+    entry["source"].append(organism.replace(" ", "_"))
+    entry["Family"].append(family)
+    entry["taxonomy"].append("NCBI:{}".format(taxonomy_id))
+    for name in ("antimicrobial", "antibacterial", "antigram_pos", "antigram_neg", "antifungal", "antiviral",
+                 "hemolytic", "toxic", "insecticidal", "anticancer"):
+        if rng.random() < 0.2:
+            entry[name].append(name)
+    for _ in range(rng.randint(0, 3)):
+        entry["PMID"].append(str(rng.randrange(1000000, 40000000)))
+    if rng.random() < 0.1:
+        entry["pdb"].append("{}ABC".format(rng.randrange(10)))
+    return entry
+
+
+def write_adaptable_fasta(fname, nentries, seed=0):
+    """
+    Write an ADAPTABLE FASTA library of `nentries` entries (streamed: the entries are not kept in memory).
+    """
+    return save_iter((generate_adaptable_entry(i, seed) for i in range(nentries)), fname)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark data.")
+    parser.add_argument("kind", choices=["xml", "fasta"], help="Unitprot XML dump or ADAPTABLE FASTA library")
+    parser.add_argument("fname", help="Output file (XML dumps ending with .gz are gzipped)")
+    parser.add_argument("--entries", type=int, default=1000, help="Number of entries")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data set")
+
+    args = parser.parse_args()
+
+    if args.kind == "xml":
+        write_uniprot_xml_dump(args.fname, args.entries, args.seed)
+    else:
+        write_adaptable_fasta(args.fname, args.entries, args.seed)
+    print("{} entries written to '{}'".format(args.entries, args.fname))
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of the ADAPTABLE library and of the Unitprot importer.
+
+Each benchmark runs in its own process (so that its peak RSS is measured on its own) on synthetic data generated by
+generators.py; the importer is benchmarked end to end against the stand-in server of server.py. Results are saved to a
+JSON file which can be compared to a baseline (e.g. the results of the main branch):
+
+    python benchmarks/run.py --sizes 1000,10000 --output results.json
+    python benchmarks/run.py --sizes 1000,10000 --output new.json --baseline results.json
+"""
+import gc
+import importlib.util
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from adaptable import Library
+from generators import write_adaptable_fasta, write_uniprot_xml_dump
+
+IMPORTER_FNAME = os.path.join(ROOT_DIR, "Unitprot-importer.py")
+
+# Default regression thresholds: relative throughput loss and relative peak RSS increase
+MAX_SLOWDOWN = 0.15
+MAX_RSS_INCREASE = 0.20
+
+
+def load_importer():
+    """
+    Import Unitprot-importer.py (its name is not a valid module name).
+    """
+    spec = importlib.util.spec_from_file_location("unitprot_importer", IMPORTER_FNAME)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # The logger is normally set up by the command line script
+    module.logger = logging.getLogger("Uniport-importer.benchmark")
+    module.logger.addHandler(logging.NullHandler())
+    module.logger.propagate = False
+    return module
+
+
+def get_data_fname(workdir, kind, size, seed):
+    """
+    Generate (once) the data of a benchmark.
+    """
+    if kind == "fasta":
+        fname = os.path.join(workdir, "library_{}_{}.fasta".format(size, seed))
+        if not os.path.isfile(fname):
+            write_adaptable_fasta(fname, size, seed)
+    else:
+        fname = os.path.join(workdir, "uniprot_{}_{}.xml".format(size, seed))
+        if not os.path.isfile(fname):
+            write_uniprot_xml_dump(fname, size, seed)
+    return fname
+
+
+def _read_library(fname, **kwargs):
+    library = Library(fname)
+    with redirect_stdout(io.StringIO()):
+        library.read(**kwargs)
+    return library
+
+
+def _parse_uniprot_entries(fname):
+    from lxml import etree as ET
+    return list(ET.parse(fname).getroot().iterchildren("{*}entry"))
+
+
+# Benchmarks: function(size, seed, workdir) -> (number of items processed, elapsed seconds)
+
+def bench_library_read(size, seed, workdir):
+    fname = get_data_fname(workdir, "fasta", size, seed)
+    start = time.perf_counter()
+    library = _read_library(fname)
+    return len(library.entries_list), time.perf_counter() - start
+
+
+def bench_library_read_parallel(size, seed, workdir):
+    fname = get_data_fname(workdir, "fasta", size, seed)
+    start = time.perf_counter()
+    library = _read_library(fname, processes=os.cpu_count() or 1)
+    return len(library.entries_list), time.perf_counter() - start
+
+
+def bench_library_load_snapshot(size, seed, workdir):
+    fname = get_data_fname(workdir, "fasta", size, seed)
+    snapshot_fname = "{}.snapshot".format(fname)
+    if not os.path.isfile(snapshot_fname):
+        _read_library(fname).dump_snapshot(snapshot_fname)
+
+    library = Library(fname)
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        if not library.load_snapshot(snapshot_fname, rebuild=False):
+            raise RuntimeError("The snapshot of '{}' is stale".format(fname))
+    return len(library.entries_list), time.perf_counter() - start
+
+
+def bench_library_save(size, seed, workdir):
+    library = _read_library(get_data_fname(workdir, "fasta", size, seed))
+    output_fname = os.path.join(workdir, "saved_{}.fasta".format(os.getpid()))
+    start = time.perf_counter()
+    library.save(output_fname, verbose=False)
+    elapsed = time.perf_counter() - start
+    os.remove(output_fname)
+    return len(library.entries), elapsed
+
+
+def bench_entry_to_fasta(size, seed, workdir):
+    library = _read_library(get_data_fname(workdir, "fasta", size, seed))
+    start = time.perf_counter()
+    for entry in library.entries_list:
+        entry.to_fasta()
+    return len(library.entries_list), time.perf_counter() - start
+
+
+def bench_xml_get_sequence(size, seed, workdir):
+    importer = load_importer()
+    trees = _parse_uniprot_entries(get_data_fname(workdir, "xml", size, seed))
+    start = time.perf_counter()
+    for tree in trees:
+        importer.get_sequence_from_uniprot_xml(tree)
+    return len(trees), time.perf_counter() - start
+
+
+def bench_xml_populate_entry(size, seed, workdir):
+    importer = load_importer()
+    trees = _parse_uniprot_entries(get_data_fname(workdir, "xml", size, seed))
+    start = time.perf_counter()
+    for tree in trees:
+        importer.build_entry_from_uniprot_xml(tree)
+    return len(trees), time.perf_counter() - start
+
+
+def bench_importer_xml_dump(size, seed, workdir):
+    fname = get_data_fname(workdir, "xml", size, seed)
+    return _run_importer(workdir, ["--xml-dump", fname, "--keywords", "KW-0929,KW-0044,KW-0081"])
+
+
+def bench_importer_server(size, seed, workdir):
+    from server import start_server
+
+    server = start_server(size, seed=seed)
+    try:
+        return _run_importer(workdir, ["--uniprot-url", server.url])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_api_async_fetch(size, seed, workdir):
+    import asyncio
+
+    import APIreader
+    from server import start_server
+    from uniprot_client import UniprotClient
+
+    async def fetch_all(entry_ids):
+        count = 0
+        async for _, entry in APIreader.iter_entries_from_ids_async(entry_ids, concurrency=10):
+            count += entry is not None
+        return count
+
+    server = start_server(size, seed=seed)
+    APIreader.client = UniprotClient(base_url=server.url)
+    try:
+        entry_ids = APIreader.get_entries_from_query("benchmark", verbose=False)
+
+        start = time.perf_counter()
+        count = asyncio.run(fetch_all(entry_ids))
+        return count, time.perf_counter() - start
+    finally:
+        APIreader.client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def _run_importer(workdir, options):
+    rundir = tempfile.mkdtemp(dir=workdir)
+    try:
+        # The importer removes the previous log file
+        open(os.path.join(rundir, "uniprot_importer.log"), "w").close()
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, IMPORTER_FNAME, "benchmark", "--max-length", "50", "--checkpoint-every", "0"]
+                       + options, cwd=rundir, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+
+        library = _read_library(os.path.join(rundir, "DATABASE_benchmark"))
+        return len(library.entries_list), elapsed
+    finally:
+        shutil.rmtree(rundir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "library_read": bench_library_read,
+    "library_read_parallel": bench_library_read_parallel,
+    "library_load_snapshot": bench_library_load_snapshot,
+    "library_save": bench_library_save,
+    "entry_to_fasta": bench_entry_to_fasta,
+    "xml_get_sequence": bench_xml_get_sequence,
+    "xml_populate_entry": bench_xml_populate_entry,
+    "importer_xml_dump": bench_importer_xml_dump,
+    "importer_server": bench_importer_server,
+    "api_async_fetch": bench_api_async_fetch,
+}
+
+# The end-to-end benchmarks are slow: they are not run on the largest data sets by default
+MAX_SIZES = {
+    "importer_xml_dump": 100000,
+    "importer_server": 10000,
+    "api_async_fetch": 10000,
+}
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    # kB on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def run_one(name, size, seed, workdir, repeat):
+    """
+    Run a benchmark in this process (called in a subprocess by run_benchmark).
+    """
+    best = None
+    items = 0
+    for _ in range(repeat):
+        gc.collect()
+        items, elapsed = BENCHMARKS[name](size, seed, workdir)
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak_rss = get_peak_rss_mb()
+    if name.startswith("importer_"):
+        peak_rss = get_peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return {"benchmark": name, "size": size, "items": items, "seconds": best,
+            "throughput": items / best if best > 0 else None, "peak_rss_mb": peak_rss}
+
+
+def run_benchmark(name, size, seed, workdir, repeat):
+    # The data are generated beforehand so that the generation does not count in the peak RSS of the benchmark
+    get_data_fname(workdir, "xml" if name.startswith("xml_") or name == "importer_xml_dump" else "fasta", size, seed)
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", name, "--sizes", str(size),
+                             "--seed", str(seed), "--workdir", workdir, "--repeat", str(repeat)],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare_results(results, baseline, max_slowdown=MAX_SLOWDOWN, max_rss_increase=MAX_RSS_INCREASE):
+    """
+    Compare results to a baseline.
+
+    :return: list of regression messages (empty if there is no regression)
+    """
+    baseline_results = {(result["benchmark"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        reference = baseline_results.get((result["benchmark"], result["size"]))
+        if reference is None or not reference["throughput"] or not result["throughput"]:
+            continue
+
+        name = "{} (size={})".format(result["benchmark"], result["size"])
+        ratio = result["throughput"] / reference["throughput"]
+        if ratio < 1 - max_slowdown:
+            regressions.append("{}: throughput {:.0f}/s -> {:.0f}/s ({:+.1%})".format(
+                name, reference["throughput"], result["throughput"], ratio - 1))
+
+        ratio = result["peak_rss_mb"] / reference["peak_rss_mb"]
+        if ratio > 1 + max_rss_increase:
+            regressions.append("{}: peak RSS {:.1f} MB -> {:.1f} MB ({:+.1%})".format(
+                name, reference["peak_rss_mb"], result["peak_rss_mb"], ratio - 1))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the benchmarks and save their results to a JSON file.")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS),
+                        help="Comma-separated list of benchmarks (default: all): {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Comma-separated list of numbers of entries (e.g. 1000,10000,100000,1000000)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark (the best is kept)")
+    parser.add_argument("--workdir", help="Directory where the synthetic data are generated and kept "
+                                          "(default: a temporary directory)")
+    parser.add_argument("--all-sizes", action="store_true",
+                        help="Also run the end-to-end benchmarks on the largest sizes")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file where the results are saved")
+    parser.add_argument("--baseline", help="JSON results to compare to: exit with status 1 on regression")
+    parser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN,
+                        help="Relative throughput loss considered as a regression")
+    parser.add_argument("--max-rss-increase", type=float, default=MAX_RSS_INCREASE,
+                        help="Relative peak RSS increase considered as a regression")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    if args.run_one is not None:
+        print(json.dumps(run_one(args.run_one, sizes[0], args.seed, args.workdir, args.repeat)))
+        sys.exit(0)
+
+    names = args.benchmarks.split(",")
+    for name in names:
+        if name not in BENCHMARKS:
+            print("ERROR: Unknown benchmark '{}'".format(name))
+            sys.exit(1)
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="adaptable-benchmarks-")
+    else:
+        os.makedirs(workdir, exist_ok=True)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "thresholds": {"max_slowdown": args.max_slowdown, "max_rss_increase": args.max_rss_increase},
+        "results": [],
+    }
+    try:
+        for size in sizes:
+            for name in names:
+                if not args.all_sizes and size > MAX_SIZES.get(name, size):
+                    continue
+                result = run_benchmark(name, size, args.seed, workdir, args.repeat)
+                results["results"].append(result)
+                print("{:<24s} {:>8d} entries: {:9.3f}s {:>12.0f} entries/s {:9.1f} MB".format(
+                    name, size, result["seconds"], result["throughput"] or 0, result["peak_rss_mb"]))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results saved to '{}'".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare_results(results, baseline, args.max_slowdown, args.max_rss_increase)
+        for message in regressions:
+            print("REGRESSION: {}".format(message))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regression compared to '{}'".format(args.baseline))
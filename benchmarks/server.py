@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Unitprot server, serving the synthetic entries of generators.py.
+
+The endpoints used by the importer are mimicked:
+- /uniprot/?query=...&columns=id[,version(entry)]&format=tab[&size=N]: the list of all the entries, by pages of N
+  entries linked by the Link header (rel="next"), like the cursor-based pagination of Unitprot,
+- /uniprot/<ID>.xml: a single entry,
+- /uniprot/?query=accession:<ID>+OR+accession:<ID>...&format=xml: several entries.
+"""
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generators import generate_uniprot_document, generate_uniprot_entry_xml, get_accession, \
+    get_index_from_accession
+
+_entry_url_pattern = re.compile(r"^/uniprot/([A-Za-z0-9]+)\.xml$")
+_accession_pattern = re.compile(r"accession:([A-Za-z0-9]+)")
+_version_pattern = re.compile(r"<entry\b[^>]*\sversion=\"([^\"]*)\"")
+
+
+class UniprotStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body of a response are sent in a single write (flushed at the end of each request): sent
+    # separately, they are delayed by Nagle's algorithm and the delayed ACK of the client on keep-alive connections
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if server.error_rate > 0 and server.random.random() < server.error_rate:
+            self._send(503, "Service unavailable", headers={"Retry-After": "0"})
+            return
+
+        url = urlsplit(self.path)
+        match = _entry_url_pattern.match(url.path)
+        if match is not None:
+            i = get_index_from_accession(match.group(1))
+            if i is None or i >= server.nentries:
+                self._send(404, "Not found")
+            else:
+                self._send(200, generate_uniprot_document([i], server.seed), "application/xml")
+        elif url.path == "/uniprot/":
+            params = parse_qs(url.query)
+            output_format = params.get("format", ["tab"])[0]
+            if output_format == "tab":
+                self._send_listing(url.path, params)
+            elif output_format == "xml":
+                indices = [get_index_from_accession(accession)
+                           for accession in _accession_pattern.findall(params.get("query", [""])[0])]
+                self._send(200, generate_uniprot_document([i for i in indices
+                                                           if i is not None and i < server.nentries], server.seed),
+                           "application/xml")
+            else:
+                self._send(400, "Unsupported format")
+        else:
+            self._send(404, "Not found")
+
+    def _send_listing(self, path, params):
+        server = self.server
+        columns = params.get("columns", ["id"])[0]
+        size = int(params.get("size", [server.nentries])[0])
+        cursor = int(params.get("cursor", [0])[0])
+        indices = range(cursor, min(cursor + size, server.nentries))
+
+        if columns == "id,version(entry)":
+            lines = ["Entry\tEntry version"]
+            lines.extend("{}\t{}".format(get_accession(i),
+                                         _version_pattern.search(generate_uniprot_entry_xml(i, server.seed)).group(1))
+                         for i in indices)
+        else:
+            lines = ["Entry"]
+            lines.extend(get_accession(i) for i in indices)
+
+        headers = {}
+        if indices.stop < server.nentries:
+            params = dict((name, values[0]) for name, values in params.items())
+            params["cursor"] = str(indices.stop)
+            headers["Link"] = '<http://{}:{}{}?{}>; rel="next"'.format(server.server_address[0],
+                                                                       server.server_address[1], path,
+                                                                       urlencode(params, safe=":[]+,()"))
+        self._send(200, "\n".join(lines) + "\n", "text/plain", headers=headers)
+
+    def _send(self, status, content, content_type="text/plain", headers=None):
+        body = content.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UniprotStandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, nentries, seed=0, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0):
+        """
+        :param int nentries: number of entries served (returned by any query)
+        :param int seed: seed of the data set (see generators.py)
+        :param float latency: delay (in seconds) added to each response
+        :param float error_rate: fraction of the requests answered by a 503 error (to exercise the retries)
+        """
+        super().__init__((host, port), UniprotStandInHandler)
+        self.nentries = nentries
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.nrequests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def count_request(self):
+        with self._lock:
+            self.nrequests += 1
+
+
+def start_server(nentries, seed=0, port=0, latency=0.0, error_rate=0.0):
+    """
+    Start a stand-in server in a background thread.
+
+    :return: the server (see its url attribute), to be stopped with server.shutdown()
+    """
+    server = UniprotStandInServer(nentries, seed=seed, port=port, latency=latency, error_rate=error_rate)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve synthetic Unitprot entries locally.")
+    parser.add_argument("--entries", type=int, default=1000, help="Number of entries served")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data set")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen to")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay (in seconds) added to each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of the requests answered by a 503")
+
+    args = parser.parse_args()
+
+    server = UniprotStandInServer(args.entries, seed=args.seed, port=args.port, latency=args.latency,
+                                  error_rate=args.error_rate)
+    print("Serving {} entries on {} (use --uniprot-url {} with the importer)".format(args.entries, server.url,
+                                                                                   server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
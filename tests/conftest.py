@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+from server import start_server
+
+
+@pytest.fixture
+def uniprot_server():
+    """
+    Local stand-in for the Unitprot server (see benchmarks/server.py), serving 50 synthetic entries.
+    """
+    server = start_server(50)
+    yield server
+    server.shutdown()
+    server.server_close()
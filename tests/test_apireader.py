@@ -0,0 +1,227 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import APIreader
+from generators import generate_uniprot_entry_xml, get_accession
+from server import start_server
+from uniprot_cache import SQLiteCache
+from uniprot_client import UniprotClient
+
+
+def get_sequence(elem):
+    return elem.find("{*}sequence").text.replace("\n", "")
+
+
+def get_expected_sequence(i):
+    return get_sequence(ET.fromstring(generate_uniprot_entry_xml(i)))
+
+
+def get_accessions(elem):
+    return [accession.text for accession in elem.iterfind("{*}accession")]
+
+
+def use_server(monkeypatch, server, **kwargs):
+    client = UniprotClient(base_url=server.url, **kwargs)
+    monkeypatch.setattr(APIreader, "client", client)
+    return client
+
+
+@pytest.fixture
+def slow_server():
+    """
+    Stand-in server answering each request after 0.2s.
+    """
+    server = start_server(50, latency=0.2)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_entries_from_ids(monkeypatch, uniprot_server):
+    use_server(monkeypatch, uniprot_server)
+
+    entries = APIreader.get_entries_from_ids([get_accession(i) for i in range(5)], chunk_size=2, verbose=False)
+
+    assert sorted(entries) == [get_accession(i) for i in range(5)]
+    for i in range(5):
+        assert get_accessions(entries[get_accession(i)])[0] == get_accession(i)
+        assert get_sequence(entries[get_accession(i)]) == get_expected_sequence(i)
+    assert uniprot_server.nrequests == 3
+
+
+def test_get_entries_from_ids_uses_cache(monkeypatch, uniprot_server, tmp_path):
+    use_server(monkeypatch, uniprot_server)
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(APIreader, "entry_cache", cache)
+    entry_ids = [get_accession(i) for i in range(5)]
+
+    APIreader.get_entries_from_ids(entry_ids[:3], verbose=False)
+    assert uniprot_server.nrequests == 1
+    assert sorted(cache.get_many(entry_ids)) == entry_ids[:3]
+
+    # Only the entries which are not cached yet are requested
+    entries = APIreader.get_entries_from_ids(entry_ids, verbose=False)
+    assert uniprot_server.nrequests == 2
+    assert sorted(cache.get_many(entry_ids)) == entry_ids
+    for i, entry_id in enumerate(entry_ids):
+        assert get_sequence(entries[entry_id]) == get_expected_sequence(i)
+
+    # The cached entries are single-entry documents, read by the single ID path too
+    for i, entry_id in enumerate(entry_ids):
+        document = APIreader.get_entry_from_id(entry_id, verbose=False)
+        assert len(document.findall("{*}entry")) == 1
+        assert get_sequence(document.find("{*}entry")) == get_expected_sequence(i)
+    assert APIreader.get_entries_from_ids(entry_ids, verbose=False).keys() == entries.keys()
+    assert uniprot_server.nrequests == 2
+    cache.close()
+
+
+def test_get_entries_from_ids_unknown_id(monkeypatch, uniprot_server):
+    use_server(monkeypatch, uniprot_server)
+
+    entries = APIreader.get_entries_from_ids([get_accession(1), get_accession(999)], verbose=False)
+
+    assert list(entries) == [get_accession(1)]
+
+
+def test_get_entry_from_id(monkeypatch, uniprot_server):
+    use_server(monkeypatch, uniprot_server)
+
+    document = APIreader.get_entry_from_id(get_accession(7), verbose=False)
+
+    assert get_accessions(document.find("{*}entry"))[0] == get_accession(7)
+    assert get_sequence(document.find("{*}entry")) == get_expected_sequence(7)
+    assert APIreader.get_entry_from_id(get_accession(999), verbose=False) is None
+
+
+def test_unreachable_server(monkeypatch):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    monkeypatch.setattr(APIreader, "client", UniprotClient(base_url="http://127.0.0.1:{}".format(port),
+                                                           max_retries=0))
+
+    assert APIreader.get_entry_from_id(get_accession(1), verbose=False) is None
+    assert APIreader.get_entries_from_ids([get_accession(1)], verbose=False) == {}
+    assert asyncio.run(APIreader.get_entries_from_ids_async([get_accession(1)])) == {get_accession(1): None}
+
+
+def test_get_entries_from_ids_async(monkeypatch, uniprot_server):
+    use_server(monkeypatch, uniprot_server)
+    entry_ids = [get_accession(i) for i in range(20)] + [get_accession(999)]
+
+    entries = asyncio.run(APIreader.get_entries_from_ids_async(entry_ids, concurrency=5))
+
+    assert sorted(entries) == sorted(entry_ids)
+    assert entries[get_accession(999)] is None
+    for i in range(20):
+        assert get_sequence(entries[get_accession(i)].find("{*}entry")) == get_expected_sequence(i)
+
+
+def test_get_entry_from_id_async_timeout(monkeypatch, slow_server):
+    use_server(monkeypatch, slow_server)
+
+    async def get_entry():
+        start = time.perf_counter()
+        entry = await APIreader.get_entry_from_id_async(get_accession(1), timeout=0.05)
+        return entry, time.perf_counter() - start
+
+    entry, elapsed = asyncio.run(get_entry())
+
+    assert entry is None
+    # Returned without waiting for the response
+    assert elapsed < 0.2
+
+
+def count_requests_in_flight(monkeypatch, client):
+    """
+    :return: list of the number of requests in flight and of the maximum number reached
+    """
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    get = client.get
+
+    def counting_get(*args, **kwargs):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        try:
+            return get(*args, **kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    monkeypatch.setattr(client, "get", counting_get)
+    return in_flight
+
+
+def test_concurrency_limit(monkeypatch, slow_server):
+    client = use_server(monkeypatch, slow_server)
+    in_flight = count_requests_in_flight(monkeypatch, client)
+    entry_ids = [get_accession(i) for i in range(12)]
+
+    start = time.perf_counter()
+    entries = asyncio.run(APIreader.get_entries_from_ids_async(entry_ids, concurrency=4))
+
+    assert all(entries[entry_id] is not None for entry_id in entry_ids)
+    assert in_flight[1] == 4
+    # 3 rounds of 4 requests
+    assert time.perf_counter() - start >= 0.6
+    assert slow_server.nrequests == 12
+
+
+def test_concurrency_above_default_executor(monkeypatch):
+    # More requests in flight than the threads of the default executor of the loop
+    concurrency = min(32, (os.cpu_count() or 1) + 4) + 4
+    server = start_server(2 * concurrency, latency=0.2)
+    try:
+        client = use_server(monkeypatch, server, pool_size=concurrency)
+        in_flight = count_requests_in_flight(monkeypatch, client)
+        entry_ids = [get_accession(i) for i in range(2 * concurrency)]
+
+        start = time.perf_counter()
+        entries = asyncio.run(APIreader.get_entries_from_ids_async(entry_ids, concurrency=concurrency))
+
+        assert all(entries[entry_id] is not None for entry_id in entry_ids)
+        assert in_flight[1] == concurrency
+        assert time.perf_counter() - start < 0.2 * 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_closing_iterator_cancels_pending_requests(monkeypatch, slow_server):
+    use_server(monkeypatch, slow_server)
+
+    async def get_first():
+        entries = APIreader.iter_entries_from_ids_async([get_accession(i) for i in range(50)], concurrency=2)
+        item = await entries.__anext__()
+        await entries.aclose()
+        return item
+
+    entry_id, document = asyncio.run(get_first())
+    # The request that was already sent completes, but no other one is sent
+    time.sleep(0.4)
+
+    assert get_sequence(document.find("{*}entry")) == get_expected_sequence(int(entry_id[1:]))
+    assert slow_server.nrequests == 2
+
+
+def test_cancel_get_entry_from_id_async(monkeypatch, slow_server):
+    use_server(monkeypatch, slow_server)
+
+    async def cancel():
+        task = asyncio.ensure_future(APIreader.get_entry_from_id_async(get_accession(1)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
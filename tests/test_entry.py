@@ -0,0 +1,21 @@
+import pytest
+
+from adaptable import Entry
+
+
+def test_properties_are_read_only():
+    entry = Entry("GIGKFLHSAKKFGKAFVGEIMNS")
+    entry["name"].append("Magainin")
+
+    properties = entry.properties
+
+    assert dict(properties) == {2: ("GIGKFLHSAKKFGKAFVGEIMNS",), 3: ("Magainin",)}
+    assert properties[4] == ()
+    with pytest.raises(AttributeError):
+        properties[3].append("Magainin 2")
+    with pytest.raises(AttributeError):
+        properties[4].append("Xenopus laevis")
+    with pytest.raises(TypeError):
+        properties[4] = ["Xenopus laevis"]
+    assert entry["name"] == ["Magainin"]
+    assert entry["source"] == []
@@ -0,0 +1,138 @@
+import threading
+import time
+
+from generators import get_accession
+from run import load_importer
+from server import start_server
+from uniprot_cache import MemoryCache, SQLiteCache
+from uniprot_client import UniprotClient
+
+
+class BlockingLoader(object):
+    """
+    load_many function of MemoryCache.get_or_load_many which waits for `release` before returning.
+    """
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, entry_ids):
+        self.calls.append(list(entry_ids))
+        self.started.set()
+        self.release.wait(5)
+        return [("value-{}".format(entry_id), 1) for entry_id in entry_ids]
+
+
+def run_in_thread(func, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", func(*args)))
+    thread.start()
+    return thread, result
+
+
+def test_get_or_load_many_shares_loads_in_progress():
+    cache = MemoryCache()
+    cache.put("a", "cached", 1)
+    first = BlockingLoader()
+    second = BlockingLoader()
+    second.release.set()
+
+    thread, result = run_in_thread(cache.get_or_load_many, ["b", "c"], first)
+    first.started.wait(5)
+    other_thread, other_result = run_in_thread(cache.get_or_load_many, ["a", "c", "d", "d"], second)
+    # Only d is loaded by the second caller, which then waits for c
+    time.sleep(0.1)
+    assert second.calls == [["d"]]
+    assert other_thread.is_alive()
+
+    first.release.set()
+    thread.join(5)
+    other_thread.join(5)
+
+    assert first.calls == [["b", "c"]]
+    assert result["value"] == ["value-b", "value-c"]
+    assert other_result["value"] == ["cached", "value-c", "value-d", "value-d"]
+    assert cache.get_stats()["shared_loads"] == 1
+    assert len(cache) == 4
+
+
+def test_get_or_load_many_failed_load():
+    cache = MemoryCache()
+    loader = BlockingLoader()
+    errors = []
+
+    def failing_load(entry_ids):
+        loader(entry_ids)
+        raise RuntimeError("download failed")
+
+    def get(load):
+        try:
+            cache.get_or_load_many(["a", "b"], load)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    thread = threading.Thread(target=get, args=(failing_load,))
+    thread.start()
+    loader.started.wait(5)
+    waiting_thread = threading.Thread(target=get, args=(lambda entry_ids: [("other", 1)] * len(entry_ids),))
+    waiting_thread.start()
+    time.sleep(0.1)
+    loader.release.set()
+    thread.join(5)
+    waiting_thread.join(5)
+
+    # The callers waiting for the load get its error, and the next calls load the entries again
+    assert errors == ["download failed", "download failed"]
+    assert cache.get_or_load_many(["a", "b"], lambda entry_ids: [("new", 1)] * len(entry_ids)) == ["new", "new"]
+
+
+def test_get_or_load_many_invalidated_during_load():
+    cache = MemoryCache()
+    loader = BlockingLoader()
+
+    thread, result = run_in_thread(cache.get_or_load_many, ["a", "b"], loader)
+    loader.started.wait(5)
+    cache.invalidate(["a"])
+    loader.release.set()
+    thread.join(5)
+
+    assert result["value"] == ["value-a", "value-b"]
+    assert "a" not in cache
+    assert "b" in cache
+
+
+def test_batch_retrieval_shares_entries_in_flight(tmp_path):
+    server = start_server(20, latency=0.3)
+    importer = load_importer()
+    importer.http_client = UniprotClient(base_url=server.url)
+    importer.entry_cache = SQLiteCache(str(tmp_path / "cache.sqlite"))
+    importer.parsed_entry_cache = MemoryCache()
+    requested = []
+    get_uniprot_xmls_from_ids = importer.get_uniprot_xmls_from_ids
+
+    def recording_get_uniprot_xmls_from_ids(entry_ids, **kwargs):
+        requested.append(list(entry_ids))
+        return get_uniprot_xmls_from_ids(entry_ids, **kwargs)
+
+    importer.get_uniprot_xmls_from_ids = recording_get_uniprot_xmls_from_ids
+    try:
+        entry_ids = [get_accession(i) for i in range(15)]
+        thread, result = run_in_thread(importer.get_uniprot_entries_from_ids, entry_ids[:10])
+        time.sleep(0.1)
+        other_trees = importer.get_uniprot_entries_from_ids(entry_ids[5:])
+        thread.join(5)
+    finally:
+        server.shutdown()
+        server.server_close()
+        importer.entry_cache.close()
+        importer.http_client.close()
+
+    # Each entry is downloaded once, by the first caller requesting it
+    assert requested == [entry_ids[:10], entry_ids[10:]]
+    assert server.nrequests == 2
+    trees = result["value"]
+    assert [tree.findtext("{*}accession") for tree in trees] == entry_ids[:10]
+    assert [tree.findtext("{*}accession") for tree in other_trees] == entry_ids[5:]
+    # The entries retrieved by the first caller are shared
+    assert all(tree is other_tree for tree, other_tree in zip(trees[5:], other_trees))
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+from adaptable import Entry, Library
+
+from conftest import ROOT_DIR
+
+
+def make_entry(sequence, organism, activity):
+    entry = Entry(sequence)
+    entry["ID"].append("uniprot{}".format(sequence[:3]))
+    entry["name"].append("Peptide {}".format(sequence[:3]))
+    entry["source"].append(organism)
+    entry[activity].append(activity)
+    # A property after the values containing whitespace: shifted if the FASTA fields are misread
+    entry["taxonomy"].append("NCBI:8355")
+    return entry
+
+
+def make_entries():
+    return [make_entry("GIGKFLHSAKKFGKAFVGEIMNS", "Xenopus laevis", "antimicrobial"),
+            make_entry("KWKLFKKIEKVGQNIRDGIIKAGPAVAVVGQATQIAK", "Hyalophora cecropia", "antibacterial")]
+
+
+def save_library(fname, entries):
+    library = Library(fname)
+    for entry in entries:
+        library.add(entry)
+    library.save(verbose=False)
+
+
+def read_bytes(fname):
+    with open(fname, "rb") as fp:
+        return fp.read()
+
+
+def test_merge_same_entries_into_saved_library(tmp_path):
+    fname = str(tmp_path / "DATABASE")
+    save_library(fname, make_entries())
+
+    library = Library(fname, lazy=True)
+    library.read()
+    counts = library.merge(make_entries(), as_stored=True)
+    library.save(str(tmp_path / "merged"), verbose=False)
+    library.close()
+
+    assert counts == {"new": 0, "updated": 0, "unchanged": 2}
+    assert read_bytes(str(tmp_path / "merged")) == read_bytes(fname)
+
+
+def test_merge_new_and_updated_entries(tmp_path):
+    fname = str(tmp_path / "DATABASE")
+    save_library(fname, make_entries()[:1])
+
+    entries = make_entries()
+    entries[0]["hemolytic"].append("hemolytic")
+    library = Library(fname, lazy=True)
+    library.read()
+    counts = library.merge(entries, as_stored=True)
+    library.save(str(tmp_path / "merged"), verbose=False)
+    library.close()
+
+    assert counts == {"new": 1, "updated": 1, "unchanged": 0}
+    records = read_bytes(str(tmp_path / "merged")).decode("utf-8").split(">")[1:]
+    assert " hemolytic; " in records[0]
+    # The new entry is saved as it is, like in the library of the import
+    assert ">" + records[1] == entries[1].to_fasta()
+
+
+def test_reimport_into_imported_library(tmp_path, uniprot_server):
+    def run_importer(*options):
+        return subprocess.run([sys.executable, os.path.join(ROOT_DIR, "Unitprot-importer.py"), "test",
+                               "--uniprot-url", uniprot_server.url, "--checkpoint-every", "0"] + list(options),
+                              cwd=str(tmp_path), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    open(str(tmp_path / "uniprot_importer.log"), "w").close()
+    run_importer()
+    output = run_importer("--merge-into", "DATABASE_test")
+
+    assert "Merge: 0 new entries, 0 updated entries, 50 unchanged entries" in output
+    assert read_bytes(str(tmp_path / "DATABASE_test_merged")) == read_bytes(str(tmp_path / "DATABASE_test"))
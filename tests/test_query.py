@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+import APIreader
+from conftest import ROOT_DIR
+from server import UniprotStandInHandler, start_server
+from uniprot_client import UniprotClient
+
+
+class FailingListingHandler(UniprotStandInHandler):
+    """
+    Answer the pages of the listing from the 1000th entry on with a 500 error.
+    """
+    def do_GET(self):
+        params = parse_qs(urlsplit(self.path).query)
+        if params.get("format", ["tab"])[0] == "tab" and int(params.get("cursor", [0])[0]) >= 1000:
+            self.server.count_request()
+            self._send(500, "Internal error")
+        else:
+            super().do_GET()
+
+
+@pytest.fixture
+def large_server():
+    server = start_server(2500)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_importer(cwd, server, *options):
+    return subprocess.run([sys.executable, os.path.join(ROOT_DIR, "Unitprot-importer.py"), "test",
+                           "--uniprot-url", server.url, "--max-retries", "0", "--checkpoint-every", "0"] +
+                          list(options), cwd=cwd, stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def count_entries(fname):
+    with open(fname, "r") as fp:
+        return sum(1 for line in fp if line.startswith(">"))
+
+
+def test_failed_listing_is_not_saved(tmp_path, large_server):
+    cwd = str(tmp_path)
+    open(os.path.join(cwd, "uniprot_importer.log"), "w").close()
+    large_server.RequestHandlerClass = FailingListingHandler
+
+    result = run_importer(cwd, large_server)
+
+    assert result.returncode == 1
+    assert "ERROR! The result of the query could not be retrieved from Unitprot" in result.stdout
+    assert not os.path.exists(os.path.join(cwd, "DATABASE_test"))
+    assert os.path.exists(os.path.join(cwd, "DATABASE_test.checkpoint"))
+
+    # The listing continues after the last page received
+    large_server.RequestHandlerClass = UniprotStandInHandler
+    result = run_importer(cwd, large_server, "--resume")
+
+    assert result.returncode == 0
+    assert count_entries(os.path.join(cwd, "DATABASE_test")) == 2500
+    assert not os.path.exists(os.path.join(cwd, "DATABASE_test.checkpoint"))
+
+
+def test_apireader_failed_listing(monkeypatch, large_server):
+    monkeypatch.setattr(APIreader, "client", UniprotClient(base_url=large_server.url, max_retries=0))
+    large_server.RequestHandlerClass = FailingListingHandler
+
+    entry_ids = []
+    with pytest.raises(requests.exceptions.HTTPError):
+        for entry_id in APIreader.iter_entries_from_query("test", verbose=False):
+            entry_ids.append(entry_id)
+    assert len(entry_ids) == 1000
+    with pytest.raises(requests.exceptions.HTTPError):
+        APIreader.get_entries_from_query("test", verbose=False)
+
+    large_server.RequestHandlerClass = UniprotStandInHandler
+    assert len(APIreader.get_entries_from_query("test", verbose=False)) == 2500
@@ -0,0 +1,39 @@
+from adaptable import Entry, Library
+
+from test_merge import make_entries, save_library
+
+
+def get_values(library):
+    return [entry._values for entry in library.entries_list]
+
+
+def test_save_with_snapshot(tmp_path):
+    fname = str(tmp_path / "DATABASE")
+    library = Library(fname)
+    for entry in make_entries():
+        library.add(entry)
+    library.save(verbose=False, snapshot=True)
+
+    read = Library(fname)
+    read.read()
+    loaded = Library(fname)
+    assert loaded.load_snapshot(rebuild=False)
+    # The snapshot holds the entries as read from the FASTA file
+    assert get_values(loaded) == get_values(read)
+
+
+def test_snapshot_ignores_unsaved_changes(tmp_path):
+    fname = str(tmp_path / "DATABASE")
+    save_library(fname, make_entries())
+
+    saved = Library(fname)
+    saved.read()
+    library = Library(fname)
+    library.read()
+    library.entries_list[0]["hemolytic"].append("hemolytic")
+    library.add(Entry("KKLLKKLLKKLL"))
+    library.dump_snapshot()
+
+    loaded = Library(fname)
+    assert loaded.load_snapshot(rebuild=False)
+    assert get_values(loaded) == get_values(saved)
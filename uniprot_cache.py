@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # file locking is only available on POSIX systems
+    fcntl = None
+
+
+def get_tmp_fname(fname):
+    """
+    :return: name of a temporary file to be renamed to fname, unique to the process and thread writing it
+    """
+    return "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+
+
+class DirectoryCache(object):
+    """
+    Legacy cache layout: one file per Unitprot entry (<cache_dir>/uniprot-<ID>).
+    """
+    prefix = "uniprot-"
+
+    def __init__(self, cache_dir=".cache"):
+        self.cache_dir = cache_dir
+
+    def _get_fname(self, entry_id):
+        return os.path.join(self.cache_dir, "{}{}".format(self.prefix, entry_id))
+
+    def get(self, entry_id):
+        try:
+            with open(self._get_fname(entry_id), "r") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def get_many(self, entry_ids):
+        contents = {}
+        for entry_id in entry_ids:
+            content = self.get(entry_id)
+            if content is not None:
+                contents[entry_id] = content
+        return contents
+
+    def put(self, entry_id, content):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self._get_fname(entry_id)
+        tmp_fname = get_tmp_fname(fname)
+        with open(tmp_fname, "w") as fp:
+            fp.write(content)
+        os.replace(tmp_fname, fname)
+
+    def put_many(self, contents):
+        for entry_id, content in contents.items():
+            self.put(entry_id, content)
+
+    def delete_many(self, entry_ids):
+        for entry_id in entry_ids:
+            try:
+                os.remove(self._get_fname(entry_id))
+            except FileNotFoundError:
+                pass
+
+    def keys(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [fname[len(self.prefix):] for fname in os.listdir(self.cache_dir)
+                if fname.startswith(self.prefix) and not fname.endswith(".tmp")]
+
+    def close(self):
+        pass
+
+    def __contains__(self, entry_id):
+        return os.path.isfile(self._get_fname(entry_id))
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class SQLiteCache(object):
+    """
+    Single-file cache: the zlib-compressed entries are stored in a SQLite database.
+
+    If max_size (in bytes of compressed data) is set, the least recently used entries are evicted once the cap is
+    exceeded.
+    """
+    # SQLite limits the number of variables in a statement
+    max_variables = 500
+
+    def __init__(self, fname=".cache.sqlite", max_size=None):
+        self.fname = fname
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "id TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, "
+                         "last_access INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._db.commit()
+
+        self._size, self._clock = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_access), 0) FROM entries").fetchone()
+
+    def get(self, entry_id):
+        return self.get_many([entry_id]).get(entry_id)
+
+    def get_many(self, entry_ids):
+        entry_ids = list(entry_ids)
+        rows = []
+        with self._lock:
+            for start in range(0, len(entry_ids), self.max_variables):
+                chunk = entry_ids[start:start + self.max_variables]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(self._db.execute("SELECT id, data FROM entries WHERE id IN ({})".format(placeholders),
+                                             chunk))
+
+            if len(rows) > 0:
+                self._clock += 1
+                self._db.executemany("UPDATE entries SET last_access=? WHERE id=?",
+                                     ((self._clock, entry_id) for entry_id, _ in rows))
+                self._db.commit()
+
+        return {entry_id: zlib.decompress(data).decode("utf-8") for entry_id, data in rows}
+
+    def put(self, entry_id, content):
+        self.put_many({entry_id: content})
+
+    def put_many(self, contents):
+        compressed = [(entry_id, zlib.compress(content.encode("utf-8"))) for entry_id, content in contents.items()]
+
+        with self._lock:
+            self._clock += 1
+            for entry_id, data in compressed:
+                row = self._db.execute("SELECT size FROM entries WHERE id=?", (entry_id,)).fetchone()
+                if row is not None:
+                    self._size -= row[0]
+                self._db.execute("INSERT OR REPLACE INTO entries (id, data, size, last_access) VALUES (?, ?, ?, ?)",
+                                 (entry_id, data, len(data), self._clock))
+                self._size += len(data)
+
+            if self.max_size is not None:
+                self._evict()
+            self._db.commit()
+
+    def delete_many(self, entry_ids):
+        entry_ids = list(entry_ids)
+        with self._lock:
+            for start in range(0, len(entry_ids), self.max_variables):
+                chunk = entry_ids[start:start + self.max_variables]
+                placeholders = ",".join("?" * len(chunk))
+                self._size -= self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE id IN ({})".format(
+                    placeholders), chunk).fetchone()[0]
+                self._db.execute("DELETE FROM entries WHERE id IN ({})".format(placeholders), chunk)
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self.max_size:
+            rows = self._db.execute("SELECT id, size FROM entries ORDER BY last_access LIMIT 100").fetchall()
+            if len(rows) == 0:
+                break
+            for entry_id, size in rows:
+                self._db.execute("DELETE FROM entries WHERE id=?", (entry_id,))
+                self._size -= size
+                if self._size <= self.max_size:
+                    break
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT id FROM entries")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __contains__(self, entry_id):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE id=?", (entry_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class MemoryCache(object):
+    """
+    In-process LRU cache of the parsed Unitprot entries (or of any other object), keyed by ID.
+
+    The cache is bounded by a number of entries and/or an approximate size in bytes (given with each value, e.g. the
+    length of the XML document the entry was parsed from). The values are shared: they must not be modified.
+    Concurrent get_or_load (or get_or_load_many) calls for the same ID share a single load.
+    """
+    def __init__(self, max_entries=1000, max_size=None):
+        """
+        :param int max_entries: maximum number of entries (no limit if None)
+        :param int max_size: maximum total size (in bytes) of the entries (no limit if None)
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        # ID -> (value, size), from the least to the most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+        # ID -> Future of the loads in progress
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        # Number of calls that waited for the load of another caller
+        self.shared_loads = 0
+        self.evictions = 0
+
+    def get(self, entry_id):
+        with self._lock:
+            return self._get(entry_id)
+
+    def _get(self, entry_id):
+        item = self._entries.get(entry_id)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(entry_id)
+        return item[0]
+
+    def put(self, entry_id, value, size=0):
+        with self._lock:
+            self._put(entry_id, value, size)
+
+    def _put(self, entry_id, value, size):
+        previous = self._entries.pop(entry_id, None)
+        if previous is not None:
+            self._size -= previous[1]
+        self._entries[entry_id] = (value, size)
+        self._size += size
+
+        while len(self._entries) > 1 and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                          (self.max_size is not None and self._size > self.max_size)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def get_or_load(self, entry_id, load):
+        """
+        Get an entry, loading it on a miss. If the entry is already being loaded by another thread, wait for that load
+        instead of starting another one.
+
+        :param load: function returning (value, size); a None value (e.g. an entry that could not be retrieved) is not
+        cached
+        :return: the value
+        """
+        return self.get_or_load_many([entry_id], lambda entry_ids: [load()])[0]
+
+    def get_or_load_many(self, entry_ids, load_many):
+        """
+        Get several entries, loading the missing ones at once (e.g. in batches of IDs). The entries already being
+        loaded by other threads are not loaded again: their loads are waited for once the missing entries are loaded.
+
+        :param list entry_ids: IDs of the entries
+        :param load_many: function returning the list of (value, size) of a list of IDs, in the same order; a None
+        value (e.g. an entry that could not be retrieved) is not cached
+        :return: list of the values, in the same order as entry_ids
+        """
+        values = {}
+        # Loads started by other callers and by this one (ID -> Future)
+        shared = {}
+        loading = {}
+        with self._lock:
+            for entry_id in dict.fromkeys(entry_ids):
+                value = self._get(entry_id)
+                if value is not None:
+                    values[entry_id] = value
+                elif entry_id in self._loading:
+                    self.shared_loads += 1
+                    shared[entry_id] = self._loading[entry_id]
+                else:
+                    loading[entry_id] = self._loading[entry_id] = Future()
+
+        if len(loading) > 0:
+            try:
+                results = load_many(list(loading))
+            except BaseException as e:
+                for future in loading.values():
+                    future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    # An entry may have been invalidated while it was loaded
+                    valid = set()
+                    for entry_id, future in loading.items():
+                        if self._loading.get(entry_id) is future:
+                            del self._loading[entry_id]
+                            valid.add(entry_id)
+
+            with self._lock:
+                for entry_id, (value, size) in zip(loading, results):
+                    if entry_id in valid and value is not None:
+                        self._put(entry_id, value, size)
+            for (entry_id, future), (value, _) in zip(loading.items(), results):
+                values[entry_id] = value
+                future.set_result(value)
+
+        # Waited for last: the loads of this caller never wait for the other callers
+        for entry_id, future in shared.items():
+            values[entry_id] = future.result()
+        return [values[entry_id] for entry_id in entry_ids]
+
+    def invalidate(self, entry_ids):
+        """
+        Remove entries (e.g. outdated ones): the next calls load them again.
+
+        :param entry_ids: iterable of IDs
+        """
+        with self._lock:
+            for entry_id in entry_ids:
+                item = self._entries.pop(entry_id, None)
+                if item is not None:
+                    self._size -= item[1]
+                self._loading.pop(entry_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._loading.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with the number of hits, misses, shared loads and evictions, the number of entries and their
+        size
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "shared_loads": self.shared_loads,
+                    "evictions": self.evictions, "entries": len(self._entries), "size": self._size}
+
+    def __contains__(self, entry_id):
+        with self._lock:
+            return entry_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def write_json(fname, data):
+    """
+    Write a JSON file atomically (readers never see a partially written file).
+    """
+    tmp_fname = get_tmp_fname(fname)
+    with open(tmp_fname, "w") as fp:
+        json.dump(data, fp)
+    os.replace(tmp_fname, fname)
+
+
+def _read_json(fname):
+    try:
+        with open(fname, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+class QueryCache(object):
+    """
+    Cache of the query results (lists of IDs), shared by concurrent importers.
+
+    Each result is stored under the hash of its parameters: <cache_dir>/<key>.tsv.gz (gzip-compressed lines) with a
+    sidecar manifest <key>.json (parameters, creation time, number of lines). A result being downloaded is appended
+    page by page to <key>.partial.tsv.gz, described by <key>.partial.json (next page, size of the complete pages), so
+    that an interrupted download can be continued; it replaces the result once complete.
+
+    Complete results are replaced atomically and can be read without locking; downloads hold an exclusive lock on
+    <key>.lock so that a single process downloads a given result.
+    """
+    def __init__(self, cache_dir=".cache_queries", ttl=None):
+        """
+        :param str cache_dir: directory of the cache
+        :param float ttl: time (in seconds) after which a result expires (never if None)
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(params):
+        """
+        :param dict params: parameters of the query (JSON-serializable)
+        """
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _get_fname(self, key, suffix):
+        return os.path.join(self.cache_dir, "{}{}".format(key, suffix))
+
+    def is_fresh(self, manifest, field="created"):
+        return self.ttl is None or time.time() - manifest[field] <= self.ttl
+
+    def get_manifest(self, key):
+        """
+        :return: the manifest of a complete result (even if expired) or None
+        """
+        manifest = _read_json(self._get_fname(key, ".json"))
+        if manifest is None or not os.path.isfile(self._get_fname(key, ".tsv.gz")):
+            return None
+        return manifest
+
+    def iter_lines(self, key):
+        with gzip.open(self._get_fname(key, ".tsv.gz"), "rt", encoding="utf-8") as fp:
+            for line in fp:
+                yield line.rstrip("\n")
+
+    def put(self, key, params, lines, created=None):
+        """
+        Store a complete result.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self._get_fname(key, ".tsv.gz")
+        tmp_fname = get_tmp_fname(fname)
+        count = 0
+        with gzip.open(tmp_fname, "wt", encoding="utf-8") as fp:
+            for line in lines:
+                fp.write(line + "\n")
+                count += 1
+        os.replace(tmp_fname, fname)
+        write_json(self._get_fname(key, ".json"), {"params": params, "lines": count,
+                                                    "created": created if created is not None else time.time()})
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Exclusive lock of a result (held while it is downloaded).
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._get_fname(key, ".lock"), "a") as fp:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def get_partial(self, key):
+        """
+        Get the state of an interrupted download (to be called with the lock held).
+
+        :return: the manifest of the partial result (with the URL of the next page) or None if there is none or it
+        expired
+        """
+        manifest = _read_json(self._get_fname(key, ".partial.json"))
+        fname = self._get_fname(key, ".partial.tsv.gz")
+        if manifest is None or not self.is_fresh(manifest, "started") or not os.path.isfile(fname) or \
+                os.path.getsize(fname) < manifest["size"]:
+            return None
+
+        # Drop a page whose writing was interrupted
+        with open(fname, "r+b") as fp:
+            fp.truncate(manifest["size"])
+        return manifest
+
+    def iter_partial_lines(self, key):
+        with gzip.open(self._get_fname(key, ".partial.tsv.gz"), "rt", encoding="utf-8") as fp:
+            for line in fp:
+                yield line.rstrip("\n")
+
+    def start_partial(self, key, params):
+        """
+        Start the download of a result (to be called with the lock held).
+        """
+        open(self._get_fname(key, ".partial.tsv.gz"), "wb").close()
+        write_json(self._get_fname(key, ".partial.json"), {"params": params, "started": time.time(), "size": 0,
+                                                            "lines": 0, "next_url": None})
+
+    def append_page(self, key, lines, next_url):
+        """
+        Append a page to the result being downloaded (to be called with the lock held). The result is complete once
+        there is no next page.
+        """
+        partial_fname = self._get_fname(key, ".partial.tsv.gz")
+        manifest = _read_json(self._get_fname(key, ".partial.json"))
+
+        # Each page is a gzip member: the concatenated members are read as a single stream
+        with open(partial_fname, "ab") as fp:
+            with gzip.GzipFile(fileobj=fp, mode="wb") as gzip_fp:
+                gzip_fp.write("".join(line + "\n" for line in lines).encode("utf-8"))
+        manifest["size"] = os.path.getsize(partial_fname)
+        manifest["lines"] += len(lines)
+        manifest["next_url"] = next_url
+
+        if next_url:
+            write_json(self._get_fname(key, ".partial.json"), manifest)
+        else:
+            os.replace(partial_fname, self._get_fname(key, ".tsv.gz"))
+            write_json(self._get_fname(key, ".json"), {"params": manifest["params"], "lines": manifest["lines"],
+                                                        "created": time.time()})
+            os.remove(self._get_fname(key, ".partial.json"))
+
+
+def open_cache(backend="sqlite", path=None, max_size=None):
+    """
+    Open a cache for the raw Unitprot entries.
+
+    :param str backend: 'sqlite' (single-file store) or 'directory' (legacy one-file-per-entry layout)
+    :param str path: location of the cache (default: '.cache.sqlite' or '.cache' depending on the backend)
+    :param int max_size: maximum size (in bytes) of the sqlite cache
+    :return: the cache object
+    """
+    if backend == "sqlite":
+        return SQLiteCache(path if path is not None else ".cache.sqlite", max_size=max_size)
+    elif backend == "directory":
+        return DirectoryCache(path if path is not None else ".cache")
+    raise ValueError("Unknown cache backend: {}".format(backend))
+
+
+def migrate_cache(source, destination, chunk_size=1000, verbose=True):
+    """
+    Copy all the entries from a cache to another one (e.g. from the legacy .cache directory to a sqlite cache).
+
+    :return: the number of entries copied
+    """
+    entry_ids = source.keys()
+    for start in range(0, len(entry_ids), chunk_size):
+        destination.put_many(source.get_many(entry_ids[start:start + chunk_size]))
+
+        if verbose:
+            print("\rMigrating cache entries: {:7d}/{:7d}".format(min(start + chunk_size, len(entry_ids)),
+                                                                  len(entry_ids)), end="")
+    if verbose:
+        print("")
+    return len(entry_ids)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Manage the cache of the Unitprot entries.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Import the legacy .cache directory into a sqlite cache")
+    migrate_parser.add_argument("--from", dest="source", default=".cache", help="Legacy cache directory")
+    migrate_parser.add_argument("--to", dest="destination", default=".cache.sqlite", help="Sqlite cache file")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        source = DirectoryCache(args.source)
+        destination = SQLiteCache(args.destination)
+        count = migrate_cache(source, destination)
+        destination.close()
+        print("{} entries imported from '{}' into '{}'".format(count, args.source, args.destination))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from uniprot_metrics import NullMetrics
+
+
+class TokenBucket(object):
+    """
+    Client-side rate limiter: at most `rate` requests per second, with bursts of up to `capacity` requests.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class UniprotClient(object):
+    """
+    HTTP client shared by all the requests sent to Unitprot.
+
+    The connections are kept alive in a pool, transient failures (timeouts, connection errors, 429 and 5xx status
+    codes) are retried with an exponential backoff (with jitter, or the delay given by the Retry-After header) and the
+    number of requests per second can be limited. The server can be changed with base_url (e.g. a local stand-in
+    server, see benchmarks/server.py). In offline mode, no request is sent.
+    """
+    retry_status_codes = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, max_retries=5, backoff_factor=0.5, max_backoff=60, rate_limit=None, pool_size=10,
+                 base_url="https://www.uniprot.org", offline=False):
+        self.base_url = base_url.rstrip("/")
+        self.offline = offline
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        # Replaced by a uniprot_metrics.Metrics to collect the HTTP metrics
+        self.metrics = NullMetrics()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, timeout=5, **kwargs):
+        """
+        Send a GET request, retrying transient failures.
+
+        :return: the response (possibly with an error status code once the retries are exhausted)
+        :raise requests.exceptions.RequestException: if the server still cannot be reached after the retries (or in
+        offline mode)
+        """
+        if self.offline:
+            raise requests.exceptions.ConnectionError("Offline mode: no request is sent to {}".format(url))
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, timeout=timeout, **kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                self.metrics.inc("http_errors_total", error=type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._get_backoff(attempt)
+            else:
+                if self.metrics.enabled:
+                    self.metrics.observe("http_request_seconds", time.perf_counter() - start)
+                    self.metrics.inc("http_responses_total", status=r.status_code)
+                    # The body of a streamed response is not read here
+                    if kwargs.get("stream"):
+                        self.metrics.inc("http_downloaded_bytes_total", int(r.headers.get("Content-Length", 0)))
+                    else:
+                        self.metrics.inc("http_downloaded_bytes_total", len(r.content))
+
+                if r.status_code not in self.retry_status_codes or attempt >= self.max_retries:
+                    return r
+                delay = self._get_retry_after(r)
+                if delay is None:
+                    delay = self._get_backoff(attempt)
+                r.close()
+
+            self.metrics.inc("http_retries_total")
+            attempt += 1
+            time.sleep(delay)
+
+    def _get_backoff(self, attempt):
+        # "Full jitter" exponential backoff
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _get_retry_after(self, r):
+        value = r.headers.get("Retry-After")
+        if value is None:
+            return None
+
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(self.max_backoff, max(0.0, delay))
+
+    def close(self):
+        self.session.close()
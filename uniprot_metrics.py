@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from uniprot_cache import get_tmp_fname
+
+
+class NullMetrics(object):
+    """
+    Metrics collector used when the instrumentation is disabled: all the hooks are no-ops.
+    """
+    enabled = False
+
+    class _NullTimer(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    _null_timer = _NullTimer()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, stage):
+        return self._null_timer
+
+    def pop_state(self):
+        return None
+
+    def merge(self, state):
+        pass
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and histograms, exported as JSON or in the Prometheus text format.
+
+    Histograms count the observations per bucket (upper bounds in seconds for the durations).
+    """
+    enabled = True
+
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, namespace="uniprot_importer", buckets=default_buckets):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        # (name, labels) -> [count per bucket (+Inf included), sum of the observations]
+        self._histograms = {}
+
+    @staticmethod
+    def _get_key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._get_key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def set(self, name, value, **labels):
+        key = self._get_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._get_key(name, labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += value
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Measure the duration of a stage (stage_seconds histogram).
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def pop_state(self):
+        """
+        :return: the counters and histograms collected so far (to be merged in another process), which are reset
+        """
+        with self._lock:
+            state = (dict(self._counters), self._histograms)
+            self._counters = defaultdict(float)
+            self._histograms = {}
+        return state
+
+    def merge(self, state):
+        if state is None:
+            return
+        counters, histograms = state
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] += value
+            for key, (counts, total) in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * len(counts), 0.0]
+                for bucket, count in enumerate(counts):
+                    histogram[0][bucket] += count
+                histogram[1] += total
+
+    def get(self, name, **labels):
+        """
+        :return: the value of a counter or gauge (0 if not set)
+        """
+        key = self._get_key(name, labels)
+        with self._lock:
+            if key in self._gauges:
+                return self._gauges[key]
+            return self._counters.get(key, 0)
+
+    def to_dict(self):
+        def get_name(name):
+            return "{}_{}".format(self.namespace, name)
+
+        data = {"counters": defaultdict(list), "gauges": defaultdict(list), "histograms": defaultdict(list)}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                data["counters"][get_name(name)].append({"labels": dict(labels), "value": value})
+            for (name, labels), value in sorted(self._gauges.items()):
+                data["gauges"][get_name(name)].append({"labels": dict(labels), "value": value})
+            for (name, labels), (counts, total) in sorted(self._histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                data["histograms"][get_name(name)].append({"labels": dict(labels), "buckets": buckets,
+                                                           "sum": total, "count": cumulative})
+        return {kind: dict(values) for kind, values in data.items()}
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels.items()) + list(extra)
+            if len(labels) == 0:
+                return ""
+            return "{{{}}}".format(",".join('{}="{}"'.format(label, str(value).replace("\\", "\\\\")
+                                                             .replace('"', '\\"').replace("\n", "\\n"))
+                                            for label, value in labels))
+
+        lines = []
+        data = self.to_dict()
+        for kind, prometheus_type in (("counters", "counter"), ("gauges", "gauge")):
+            for name, samples in data[kind].items():
+                lines.append("# TYPE {} {}".format(name, prometheus_type))
+                for sample in samples:
+                    lines.append("{}{} {}".format(name, format_labels(sample["labels"]), sample["value"]))
+        for name, samples in data["histograms"].items():
+            lines.append("# TYPE {} histogram".format(name))
+            for sample in samples:
+                for bound, count in sample["buckets"].items():
+                    lines.append("{}_bucket{} {}".format(name, format_labels(sample["labels"], [("le", bound)]),
+                                                         count))
+                lines.append("{}_sum{} {}".format(name, format_labels(sample["labels"]), sample["sum"]))
+                lines.append("{}_count{} {}".format(name, format_labels(sample["labels"]), sample["count"]))
+        return "\n".join(lines) + "\n"
+
+    def save(self, fname, output_format="json"):
+        """
+        :param str output_format: 'json' or 'prometheus' (text exposition format)
+        """
+        if output_format == "json":
+            content = json.dumps(self.to_dict(), indent=2)
+        elif output_format == "prometheus":
+            content = self.to_prometheus()
+        else:
+            raise ValueError("Unknown metrics format: {}".format(output_format))
+
+        tmp_fname = get_tmp_fname(fname)
+        with open(tmp_fname, "w") as fp:
+            fp.write(content)
+        os.replace(tmp_fname, fname)
+
+
+class ProgressReporter(object):
+    """
+    Print a progress line (count, throughput and ETA) at most every `interval` seconds.
+    """
+    def __init__(self, total=None, interval=10.0, stream=None):
+        self.total = total
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+
+        self.start_time = time.monotonic()
+        self._next_report = self.start_time + interval
+
+    def update(self, count):
+        now = time.monotonic()
+        if now < self._next_report:
+            return
+        self._next_report = now + self.interval
+        self.stream.write(self.format(count, now) + "\n")
+        self.stream.flush()
+
+    def format(self, count, now=None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.start_time
+        rate = count / elapsed if elapsed > 0 else 0.0
+
+        if self.total is None:
+            return "Progress: {} entries, {:.1f} entries/s, elapsed {}".format(count, rate, _format_duration(elapsed))
+        eta = (self.total - count) / rate if rate > 0 else None
+        return "Progress: {}/{} entries ({:.1f}%), {:.1f} entries/s, ETA {}".format(
+            count, self.total, 100.0 * count / self.total if self.total > 0 else 100.0, rate,
+            _format_duration(eta) if eta is not None else "unknown")
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+
+
+class WarningCollector(object):
+    """
+    Aggregate the warnings of an import: number of warnings per category and key (e.g. the type of the ignored
+    database references) and the first `max_examples` messages of each of them.
+
+    The messages are built lazily: only when they are kept as examples or, in verbose mode, logged in full.
+    """
+    # Titles of the categories in the summary
+    titles = OrderedDict([
+        ("unknown_database", "Database references ignored"),
+        ("potential_property", "Potential bioproperties found in ignored elements"),
+        ("ignored_tag", "Ignored elements"),
+    ])
+
+    # Maximum length of the examples in the summary
+    max_example_length = 300
+
+    def __init__(self, verbose=False, max_examples=3):
+        """
+        :param bool verbose: return all the messages to be logged (the full warnings of the previous versions)
+        :param int max_examples: number of messages kept for each category and key
+        """
+        self.verbose = verbose
+        self.max_examples = max_examples
+
+        # (category, key) -> count, in the order of the first warning
+        self.counts = OrderedDict()
+        # (category, key) -> messages
+        self.examples = {}
+
+    def add(self, category, key, get_message=None, logged=True):
+        """
+        Count a warning.
+
+        :param str category: category of the warning (see titles)
+        :param str key: key of the warning within its category
+        :param get_message: function returning the message of the warning (None if there is no message)
+        :param bool logged: the message is logged in full in verbose mode
+        :return: the message if it has to be logged, None otherwise
+        """
+        item = (category, key)
+        count = self.counts.get(item, 0)
+        self.counts[item] = count + 1
+
+        if get_message is None:
+            return None
+        verbose = self.verbose and logged
+        if count >= self.max_examples and not verbose:
+            return None
+
+        message = get_message()
+        if count < self.max_examples:
+            self.examples.setdefault(item, []).append(message)
+        return message if verbose else None
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def get_counts_by_category(self):
+        counts = OrderedDict()
+        for (category, _), count in self.counts.items():
+            counts[category] = counts.get(category, 0) + count
+        return counts
+
+    def pop_state(self):
+        """
+        :return: the warnings collected so far (to be merged in another process), which are reset
+        """
+        state = (self.counts, self.examples)
+        self.counts = OrderedDict()
+        self.examples = {}
+        return state
+
+    def merge(self, state):
+        """
+        Add the warnings collected by another collector (the examples kept are the first ones, in merge order).
+        """
+        counts, examples = state
+        for item, count in counts.items():
+            self.counts[item] = self.counts.get(item, 0) + count
+        for item, messages in examples.items():
+            kept = self.examples.setdefault(item, [])
+            kept.extend(messages[:self.max_examples - len(kept)])
+
+    def format_summary(self):
+        """
+        :return: compact report of the warnings: count per category and key, with the examples
+        """
+        lines = ["Summary of the warnings ({} in total):".format(len(self))]
+        counts_by_category = self.get_counts_by_category()
+        categories = list(self.titles) + [category for category in counts_by_category if category not in self.titles]
+        for category in categories:
+            if category not in counts_by_category:
+                continue
+            lines.append("{}: {}".format(self.titles.get(category, category), counts_by_category[category]))
+
+            items = [(item, count) for item, count in self.counts.items() if item[0] == category]
+            items.sort(key=lambda item_count: -item_count[1])
+            for item, count in items:
+                lines.append("  - {}: {}".format(item[1], count))
+                for message in self.examples.get(item, ()):
+                    message = " ".join(message.split())
+                    if len(message) > self.max_example_length:
+                        message = message[:self.max_example_length - 3] + "..."
+                    lines.append("      e.g. {}".format(message))
+        return "\n".join(lines)